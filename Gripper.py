@@ -1,64 +1,94 @@
-import inspect
-
-####Single command example usage####
-# rob.send_program(rq_close())
-
-def rq_reset():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_activate_and_wait():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_activate():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_close():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_close_and_wait():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_open():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_open_and_wait():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_is_object_detected():
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "()\nend"
-
-
-def rq_move(number):
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "(" + str(
-        number) + ")\nend"
-
-
-def rq_set_force(number):
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "(" + str(
-        number) + ")\nend"
-
-
-def rq_set_speed(number):
-    return open("Gripper.script", "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3] + "(" + str(
-        number) + ")\nend"
-
-
-####Multiple commands example usage####
-# commands = ["rq_open", "rq_close"]
-# rob.send_program(rq_multiple_commands(commands))
-def rq_multiple_commands(commands):
-    l = open("Gripper.script", "rb").read().decode("utf-8")
-    for command in commands:
-        if command in globals():
-            l += "  " + command + "()\n"
-        else:
-            return command
-    l += "end"
-    return l
+import os
+from functools import lru_cache
+
+__all__ = [
+    'rq_reset', 'rq_activate_and_wait', 'rq_activate', 'rq_close', 'rq_close_and_wait', 'rq_open',
+    'rq_open_and_wait', 'rq_is_object_detected', 'rq_move', 'rq_set_force', 'rq_set_speed', 'rq_multiple_commands'
+]
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Gripper.script')
+"""Robotiq URCap preamble, every gripper program starts with this"""
+
+COMMANDS = frozenset(__all__) - {'rq_multiple_commands'}
+"""Gripper commands that can be used in `rq_multiple_commands`"""
+
+
+@lru_cache(maxsize=1)
+def preamble() -> str:
+    """
+    Read `Gripper.script` once. Every program built after the first call reuses the same string.
+    """
+    with open(SCRIPT_PATH, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+@lru_cache(maxsize=64)
+def program(command: str, argument=None) -> str:
+    """
+    Build the program for a single gripper command, cached on `command` and `argument`.
+    """
+    if argument is None:
+        return preamble() + '  ' + command + '()\nend'
+
+    return preamble() + '  ' + command + '(' + str(argument) + ')\nend'
+
+
+####Single command example usage####
+# rob.send_program(rq_close())
+
+def rq_reset():
+    return program('rq_reset')
+
+
+def rq_activate_and_wait():
+    return program('rq_activate_and_wait')
+
+
+def rq_activate():
+    return program('rq_activate')
+
+
+def rq_close():
+    return program('rq_close')
+
+
+def rq_close_and_wait():
+    return program('rq_close_and_wait')
+
+
+def rq_open():
+    return program('rq_open')
+
+
+def rq_open_and_wait():
+    return program('rq_open_and_wait')
+
+
+def rq_is_object_detected():
+    return program('rq_is_object_detected')
+
+
+def rq_move(number):
+    return program('rq_move', number)
+
+
+def rq_set_force(number):
+    return program('rq_set_force', number)
+
+
+def rq_set_speed(number):
+    return program('rq_set_speed', number)
+
+
+####Multiple commands example usage####
+# commands = ["rq_open", "rq_close"]
+# rob.send_program(rq_multiple_commands(commands))
+def rq_multiple_commands(commands):
+    l = preamble()
+    for command in commands:
+        if command in COMMANDS:
+            l += "  " + command + "()\n"
+        else:
+            return command
+    l += "end"
+    return l
@@ -0,0 +1,105 @@
+import contextlib
+import glob
+import io
+import os
+import timeit
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from camera import Camera
+from util import Vec2, Object
+
+SAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'response camera *.jpeg')))
+
+# Settings of the cameras in `main.py`, the samples are named after the last number of the camera ip
+CAMERAS = {
+    '8': dict(ip='10.1.1.8', offsets=Vec2(140, -180), offset_scale=Vec2(1.2, 1.13), invert=Vec2(1, -1),
+              camera_cut=(Vec2(0, 160), Vec2(540, 450)), camera_threshold=25),
+    '7': dict(ip='10.1.1.7', offsets=Vec2(-520, -240), offset_scale=Vec2(1.14, 1.2), invert=Vec2(1, 1),
+              camera_cut=(Vec2(0, 50), Vec2(400, 450)), camera_threshold=25),
+}
+
+
+def legacy_decode(camera: Camera, data: bytes):
+    """
+    The old `Camera.get_image` pipeline: decode in color, cut, convert to grayscale.
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    img = cv2.imdecode(arr, -1)
+
+    x, y = camera.camera_cut[0].to_tuple()
+    h, w = camera.camera_cut[1].to_tuple()
+
+    img = img[x:w, y:h]
+
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    return img
+
+
+def allocated(func) -> tuple[int, int]:
+    """
+    Blocks and bytes allocated at the peak of one call.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    blocks = sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename')
+                 if stat.count_diff > 0)
+    tracemalloc.stop()
+    del result
+
+    return blocks, peak
+
+
+def camera_for(sample: str, scale=1) -> Camera:
+    name = os.path.basename(sample)[len('response camera '):].split()[0].split('.')[0]
+    return Camera(**CAMERAS[name], objects=[Object.CUBE, Object.CYLINDER], scale=scale)
+
+
+def detections(camera: Camera, img) -> tuple[int, int]:
+    return len(camera.get_cubes(img) or ()), len(camera.get_cylinders(img) or ())
+
+
+if __name__ == '__main__':
+    assert SAMPLES, 'No sample images found'
+
+    print(f'{"sample":<26}{"pipeline":<26}{"ms/frame":>10}{"ms/detect":>11}{"peak KiB":>10}'
+          f'{"blocks":>8}{"cubes, cylinders":>18}')
+
+    for sample in SAMPLES:
+        with open(sample, 'rb') as f:
+            data = f.read()
+
+        full = camera_for(sample)
+        legacy = legacy_decode(full, data)
+        gray = full.decode(data)
+
+        assert gray.shape == legacy.shape
+        difference = int(np.abs(gray.astype(np.int16) - legacy).max())
+
+        cases = [('legacy color + cvtColor', full, lambda: legacy_decode(full, data))]
+        for scale in (1, 2, 4):
+            camera = camera_for(sample, scale)
+            cases.append((f'grayscale, scale {scale}', camera, lambda camera=camera: camera.decode(data)))
+
+        for name, camera, func in cases:
+            img = func()
+
+            # The detectors print every object out of reach
+            with contextlib.redirect_stdout(io.StringIO()):
+                frame = min(timeit.repeat(func, number=50, repeat=3)) / 50
+                detect = min(timeit.repeat(lambda: (camera.get_cubes(img), camera.get_cylinders(img)),
+                                           number=10, repeat=3)) / 10
+                found = detections(camera, img)
+
+            blocks, peak = allocated(func)
+
+            print(f'{os.path.basename(sample):<26}{name:<26}{frame * 1000:>10.3f}{detect * 1000:>11.3f}'
+                  f'{peak / 1024:>10.0f}{blocks:>8}{str(found):>18}')
+
+        print(f'{"":<26}max gray difference to legacy: {difference}')
@@ -0,0 +1,171 @@
+"""
+Run the camera detectors on recorded frames, without the cameras.
+
+    python bench_detect.py                              # the sample frames in this directory
+    python bench_detect.py frames/ --camera 8 --json results.json
+    python bench_detect.py --baseline results.json      # compare against an earlier run
+    python bench_detect.py --clutter 3000               # add specks to see how detection scales with clutter
+
+Frames named like `response camera 8.jpeg` use the settings of that camera, others need `--camera`.
+The exit code is 1 when `--baseline` finds a changed detection count or a stage slower than `--tolerance`.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from bench_camera import CAMERAS, camera_for
+from camera import Camera
+from util import Object, PhaseTimer
+
+STAGES = ['decode', 'threshold', 'contours', 'cube_filter', 'blur', 'hough']
+
+
+def add_clutter(data: bytes, count: int, seed=0) -> bytes:
+    """
+    Draw `count` small black and white specks on a JPEG, each one becomes a contour after thresholding.
+    """
+    rng = np.random.default_rng(seed)
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    for y, x, radius, color in zip(rng.integers(0, img.shape[0], count), rng.integers(0, img.shape[1], count),
+                                   rng.integers(1, 4, count), rng.choice([0, 255], count)):
+        cv2.circle(img, (int(x), int(y)), int(radius), (int(color),) * 3, -1)
+
+    return cv2.imencode('.jpg', img)[1].tobytes()
+
+
+def run_frame(camera: Camera, data: bytes, repeat: int) -> dict:
+    """
+    Decode and detect `repeat` times, returns the mean and min time of every stage and what was found.
+    """
+    camera.timings = PhaseTimer()
+
+    # The detectors print every object out of reach
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            with camera.timings.phase('total'):
+                img = camera.decode(data)
+                cubes = camera.get_cubes(img) or []
+                cylinders = camera.get_cylinders(img) or []
+
+    stages = {}
+    for name in STAGES + ['total']:
+        durations = camera.timings.durations.get(name, [])
+        if durations:
+            stages[name] = {'mean_ms': sum(durations) / len(durations) * 1000, 'min_ms': min(durations) * 1000}
+
+    camera.timings = None
+
+    return {
+        'stages': stages,
+        'cubes': [vec.to_tuple() for vec in cubes],
+        'cylinders': [vec.to_tuple() for vec in cylinders],
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Differences to `baseline` that count as a regression.
+    """
+    problems = []
+    previous = {frame['file']: frame for frame in baseline['frames']}
+
+    for frame in results['frames']:
+        old = previous.get(frame['file'])
+        if old is None:
+            continue
+
+        for obj in ('cubes', 'cylinders'):
+            if len(frame[obj]) != len(old[obj]):
+                problems.append(f'{frame["file"]}: {len(old[obj])} -> {len(frame[obj])} {obj}')
+
+        for name, stage in frame['stages'].items():
+            if name in old['stages'] and stage['min_ms'] > old['stages'][name]['min_ms'] * (1 + tolerance):
+                problems.append(f'{frame["file"]}: {name} {old["stages"][name]["min_ms"]:.3f} -> '
+                                f'{stage["min_ms"]:.3f} ms')
+
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory of JPEG frames, or a single frame')
+    parser.add_argument('--pattern', default='response camera *.jpeg', help='frames to use in the directory')
+    parser.add_argument('--camera', choices=sorted(CAMERAS), help='camera settings for every frame')
+    parser.add_argument('--scale', type=int, default=1, help='decode scale, see Camera')
+    parser.add_argument('--clutter', type=int, default=0, help='specks to add to every frame')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per frame')
+    parser.add_argument('--json', help='write the results to this file, - for stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown of a stage, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    files = [args.path] if os.path.isfile(args.path) else sorted(glob.glob(os.path.join(args.path, args.pattern)))
+    if not files:
+        parser.error(f'No frames matching {args.pattern!r} in {args.path}')
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'clutter': args.clutter,
+        'frames': [],
+    }
+
+    for file in files:
+        with open(file, 'rb') as f:
+            data = f.read()
+
+        if args.clutter:
+            data = add_clutter(data, args.clutter)
+
+        if args.camera:
+            camera = Camera(**CAMERAS[args.camera], objects=[Object.CUBE, Object.CYLINDER], scale=args.scale)
+        else:
+            camera = camera_for(file, args.scale)
+
+        results['frames'].append({'file': os.path.basename(file), 'camera': camera.ip,
+                                  **run_frame(camera, data, args.repeat)})
+
+    out = sys.stderr if args.json == '-' else sys.stdout
+
+    print(f'{"frame":<26}' + ''.join(f'{name:>12}' for name in STAGES + ['total']) + f'{"cubes":>7}{"cyl.":>6}',
+          file=out)
+    for frame in results['frames']:
+        times = ''.join(f'{frame["stages"][name]["min_ms"]:>12.3f}' if name in frame['stages'] else f'{"-":>12}'
+                        for name in STAGES + ['total'])
+        print(f'{frame["file"]:<26}{times}{len(frame["cubes"]):>7}{len(frame["cylinders"]):>6}', file=out)
+    print('(min ms per stage)', file=out)
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+
+        for problem in problems:
+            print(f'Regression: {problem}', file=out)
+
+        return 1 if problems else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import inspect
+import timeit
+
+import Gripper
+
+
+# The functions below are the old `Gripper.py` implementation, kept here to compare against.
+def legacy_rq_open():
+    return open(Gripper.SCRIPT_PATH, "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3][7:] + "()\nend"
+
+
+def legacy_rq_close():
+    return open(Gripper.SCRIPT_PATH, "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3][7:] + "()\nend"
+
+
+def legacy_rq_set_speed(number):
+    return open(Gripper.SCRIPT_PATH, "rb").read().decode("utf-8") + "  " + inspect.stack()[0][3][7:] + "(" + str(
+        number) + ")\nend"
+
+
+def commands_per_second(func, number: int) -> float:
+    return number / timeit.timeit(func, number=number)
+
+
+if __name__ == '__main__':
+    assert legacy_rq_open() == Gripper.rq_open()
+    assert legacy_rq_close() == Gripper.rq_close()
+    assert legacy_rq_set_speed(250) == Gripper.rq_set_speed(250)
+
+    cases = [
+        ('rq_open', legacy_rq_open, Gripper.rq_open),
+        ('rq_close', legacy_rq_close, Gripper.rq_close),
+        ('rq_set_speed(250)', lambda: legacy_rq_set_speed(250), lambda: Gripper.rq_set_speed(250)),
+    ]
+
+    print(f'{"command":<20}{"legacy cmd/s":>15}{"cached cmd/s":>15}{"speedup":>10}')
+    for name, legacy, cached in cases:
+        old = commands_per_second(legacy, 200)
+        new = commands_per_second(cached, 200_000)
+        print(f'{name:<20}{old:>15.0f}{new:>15.0f}{new / old:>9.0f}x')
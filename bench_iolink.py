@@ -0,0 +1,124 @@
+"""
+Check the IO-Link decoders against recorded responses of the master and time them.
+
+    python bench_iolink.py                                  # parity check and timings
+    python bench_iolink.py --capture "no object" --port 4   # record a response of the master
+
+Recorded responses are kept in `iolink_responses.json`. Capture one per sensor state seen on the conveyor: an object
+in front of the sensor, no object and a sensor out of range. A capture replaces the entry with the same name.
+"""
+import argparse
+import json
+import os
+import time
+import timeit
+
+import iolink
+from http_client import client_for
+
+RESPONSES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iolink_responses.json')
+MASTER_URL = 'http://10.1.1.9'
+"""Same master as `Conveyor.iolink_url`"""
+
+
+def legacy_get_distance(response: dict) -> int:
+    """
+    The old `Conveyor.get_distance` decoding.
+    """
+    data = str(response['data'])
+
+    if data[53] == "2":
+        d = data[68] + data[69]
+        return int(d, 16)
+    else:
+        return 0
+
+
+def load_fixtures() -> dict:
+    with open(RESPONSES_FILE) as f:
+        return json.load(f)
+
+
+def capture(name: str, port: int, url: str):
+    """
+    Read `port` from the master and store the response as it was returned.
+    """
+    r = client_for(url, timeout=2.0).post('/', json=iolink.request([port]), endpoint='/getdatamulti')
+    response = r.json()
+    reading = iolink.decode_response(response)[port]
+
+    fixtures = load_fixtures()
+    fixtures['responses'] = [entry for entry in fixtures['responses'] if entry['name'] != name]
+    fixtures['responses'].append({
+        'name': name,
+        'port': port,
+        'source': f'captured {time.strftime("%Y-%m-%d")} from {url}',
+        'expected': {'distance': reading.distance, 'status': reading.status},
+        'response': response,
+    })
+
+    with open(RESPONSES_FILE, 'w') as f:
+        json.dump(fixtures, f, indent=2)
+
+    print(f'{name}: port {port} {reading}')
+
+
+def check(entries: list[dict]):
+    """
+    The structured decoders have to agree with the expected readings and with the old string slicing.
+    """
+    responses = [entry['response'] for entry in entries]
+
+    for entry in entries:
+        reading = iolink.decode_response(entry['response'])[entry['port']]
+        expected = (entry['expected']['distance'], entry['expected']['status'])
+
+        assert (reading.distance, reading.status) == expected, (entry['name'], reading)
+        assert legacy_get_distance(entry['response']) == (reading.distance or 0), entry['name']
+
+    batch = iolink.decode_batch(responses)
+    readings = [reading for response in responses for reading in iolink.decode_response(response).values()]
+    assert batch['distance'].tolist() == [reading.distance or 0 for reading in readings]
+    assert batch['in_range'].tolist() == [reading.in_range for reading in readings]
+
+    # A changed key order breaks the string slicing but not the structured decoder
+    reordered = {'data': {'/iolinkmaster/port[1]/iolinkdevice/pdin': {'data': '01D2', 'code': 200}}}
+    assert iolink.decode_response(reordered)[1].distance == 29
+    assert legacy_get_distance(reordered) != 29
+
+
+def bench(entries: list[dict], n=1000):
+    responses = [entry['response'] for entry in entries] * n
+    all_ports = {'data': {key: value for entry in entries for key, value in entry['response']['data'].items()}}
+
+    cases = [
+        ('legacy string slicing', lambda: [legacy_get_distance(response) for response in responses]),
+        ('decode_response', lambda: [iolink.decode_response(response) for response in responses]),
+        ('decode_batch', lambda: iolink.decode_batch(responses)),
+        (f'decode_batch, {len(all_ports["data"])} ports per response', lambda: iolink.decode_batch([all_ports] * n)),
+    ]
+
+    print(f'{"decoder":<38}{"us per port":>12}')
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=10, repeat=5)) / 10
+        print(f'{name:<38}{seconds / len(responses) * 1e6:>12.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--capture', metavar='NAME', help='record a response of the master under this name')
+    parser.add_argument('--port', type=int, default=1, help='port to capture')
+    parser.add_argument('--url', default=MASTER_URL, help='IO-Link master')
+    args = parser.parse_args()
+
+    if args.capture:
+        capture(args.capture, args.port, args.url)
+    else:
+        entries = load_fixtures()['responses']
+        check(entries)
+
+        reconstructed = [entry['name'] for entry in entries if entry['source'] == 'reconstructed']
+        if reconstructed:
+            print(f'Not captured from the master yet: {", ".join(reconstructed)}')
+
+        bench(entries)
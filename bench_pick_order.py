@@ -0,0 +1,94 @@
+import argparse
+import random
+import statistics
+import timeit
+from copy import deepcopy
+
+import pick_order
+from orchestrator import Cell
+from sim import CORDS, Simulation, SimTable
+from stack import Stack
+from util import Vec2, Object
+
+
+def scene(seed: int, count: int) -> tuple[list, list]:
+    """
+    `count` objects at random places on the table of rob1, in the order they were detected, and the stack slots they
+    are placed in, both at the height the tool passes over them.
+    """
+    rng = random.Random(seed)
+    cords = CORDS['rob1']
+    table = SimTable('rob1', cords['object']['get'].to_vec2(), Simulation.table_size, count, rng)
+
+    while len(table.objects) < count:
+        if not table.add_random():
+            # Start over when the objects left no room for another one
+            table.objects.clear()
+
+    stack = Stack(name='r1_PS', coords=deepcopy(cords['object']['place']), direction=Vec2(0.0, -1.0), height=2,
+                  obj=Object.CUBE)
+    over = Object.CUBE['over']
+
+    return [position.to_vec3() + over for _, position in table.objects], [slot + over
+                                                                         for slot in stack.upcoming(count)]
+
+
+def travel_via_idle(idle, picks: list, drops: list, order: list[int]) -> float:
+    """
+    Travel when the robot returns to idle after every object, like the cell did before the pick order was planned.
+    """
+    return sum(pick_order.travel(idle, [picks[index]], [drop], [0], idle) for index, drop in zip(order, drops))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Arm travel of the pick orders on random tables')
+    parser.add_argument('--scenes', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=Cell.sort_batch, help='Objects sorted after one look')
+    args = parser.parse_args()
+
+    idle = CORDS['rob1']['idlePose']
+
+    orders = {
+        'detected, direct': lambda picks, drops: list(range(len(picks))),
+        'nearest neighbour': lambda picks, drops: pick_order.nearest_neighbour(idle, picks, drops),
+        'planned': lambda picks, drops: pick_order.plan(idle, picks, drops, idle, args.batch),
+    }
+
+    for count in (2, args.batch, 6):
+        sorted_count = min(count, args.batch)
+        results = {'detected, via idle': []} | {name: [] for name in orders}
+
+        for seed in range(args.scenes):
+            picks, drops = scene(seed, count)
+
+            for name, order in orders.items():
+                batch = order(picks, drops)[:args.batch]
+                results[name].append(pick_order.travel(idle, picks, drops, batch, idle))
+
+            results['detected, via idle'].append(travel_via_idle(idle, picks, drops, list(range(sorted_count))))
+
+        baseline = statistics.mean(results['detected, via idle'])
+
+        print(f'{count} objects on the table, {sorted_count} sorted')
+        print(f'{"order":<22}{"travel m":>10}{"per object":>12}{"saved":>8}')
+        for name, lengths in results.items():
+            mean = statistics.mean(lengths)
+            print(f'{name:<22}{mean:>10.3f}{mean / sorted_count:>12.3f}{1 - mean / baseline:>8.0%}')
+
+        picks, drops = scene(0, count)
+        seconds = timeit.timeit(lambda: pick_order.plan(idle, picks, drops, idle, args.batch), number=20) / 20
+        print(f'planning takes {seconds * 1000:.2f} ms\n')
+
+    # Loading the conveyor goes through idle, every object is a round trip from idle
+    for count in (args.batch, 6):
+        loaded = min(count, args.batch)
+        detected, closest = [], []
+
+        for seed in range(args.scenes):
+            picks, _ = scene(seed, count)
+            trips = [2 * pick_order.distance(idle, pick) for pick in picks]
+            detected.append(sum(trips[:loaded]))
+            closest.append(sum(sorted(trips)[:loaded]))
+
+        print(f'Loading {loaded} of {count} objects: detected order {statistics.mean(detected):.3f} m, closest first '
+              f'{statistics.mean(closest):.3f} m, saved {1 - statistics.mean(closest) / statistics.mean(detected):.0%}')
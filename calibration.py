@@ -0,0 +1,144 @@
+"""
+Mapping from camera pixels to robot coordinates.
+
+Fit a calibration from reference points, pairs of a pixel and the robot position of the same point:
+
+    python calibration.py points.json calibration_camera_8.json [--affine]
+
+where `points.json` is `[[[px, py], [rx, ry]], ...]`, pixels in the full resolution image cut to `camera_cut` and
+robot positions in meters.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from util import Vec2
+
+
+class CalibrationException(Exception):
+    pass
+
+
+@dataclass
+class Calibration:
+    """
+    Projective transform from camera pixels to robot `(x, y)` in meters.
+    """
+    matrix: np.ndarray
+    """3x3 homography, an affine calibration has `(0, 0, 1)` as the last row"""
+    model: str = 'homography'
+    error: float = 0.0
+    """Root mean square distance in meters between the reference points and their transformed pixels"""
+    created: str = field(default_factory=lambda: time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    def __post_init__(self):
+        self.matrix = np.asarray(self.matrix, dtype=np.float64)
+
+        if self.matrix.shape != (3, 3):
+            raise CalibrationException(f'The calibration matrix needs to be 3x3, got {self.matrix.shape}')
+
+    def transform(self, points) -> np.ndarray:
+        """
+        Robot coordinates of N pixels, `points` is anything with shape `(N, 2)`. Returns an `(N, 2)` array.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        mapped = points @ self.matrix[:, :2].T + self.matrix[:, 2]
+
+        return mapped[:, :2] / mapped[:, 2:]
+
+    @classmethod
+    def from_points(cls, pixels, robot, model='homography') -> Calibration:
+        """
+        Least squares fit of `model` ('homography' or 'affine') to reference points.
+        A homography needs at least 4 points, an affine transform at least 3.
+        """
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+        robot = np.asarray(robot, dtype=np.float64).reshape(-1, 2)
+
+        if len(pixels) != len(robot):
+            raise CalibrationException(f'Got {len(pixels)} pixels but {len(robot)} robot positions')
+
+        if model == 'homography':
+            if len(pixels) < 4:
+                raise CalibrationException(f'A homography needs at least 4 reference points, got {len(pixels)}')
+
+            matrix, _ = cv2.findHomography(pixels, robot, 0)
+        elif model == 'affine':
+            if len(pixels) < 3:
+                raise CalibrationException(f'An affine calibration needs at least 3 reference points, '
+                                           f'got {len(pixels)}')
+
+            # Solve robot = [px, py, 1] @ A for the 3x2 matrix A
+            design = np.hstack([pixels, np.ones((len(pixels), 1))])
+            solution, *_ = np.linalg.lstsq(design, robot, rcond=None)
+            matrix = np.vstack([solution.T, [0.0, 0.0, 1.0]])
+        else:
+            raise CalibrationException(f'Unknown calibration model {model!r}, use homography or affine')
+
+        if matrix is None:
+            raise CalibrationException('Could not fit a calibration, are the reference points in a line?')
+
+        calibration = cls(matrix, model)
+        calibration.error = float(np.sqrt(((calibration.transform(pixels) - robot) ** 2).sum(axis=1).mean()))
+
+        return calibration
+
+    @classmethod
+    def from_offsets(cls, offsets: Vec2, offset_scale: Vec2, invert: Vec2) -> Calibration:
+        """
+        The hand-tuned model the cameras used before calibrations: pixels are offset, inverted and scaled to
+        millimeters, then the axes are swapped to robot `(x, y)` in meters.
+        """
+        k = invert.x * invert.y / 1000
+
+        return cls(np.array([
+            [0.0, k * offset_scale.y, k * offset_scale.y * offsets.y],
+            [k * offset_scale.x, 0.0, k * offset_scale.x * offsets.x],
+            [0.0, 0.0, 1.0],
+        ]), 'affine')
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'model': self.model, 'matrix': self.matrix.tolist(), 'error': self.error,
+                       'created': self.created}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> Calibration:
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(data['matrix'], data.get('model', 'homography'), data.get('error', 0.0),
+                   data.get('created', ''))
+
+
+def load_optional(path: str) -> Optional[Calibration]:
+    """
+    The calibration saved at `path`, or `None` when the camera has not been calibrated yet.
+    """
+    return Calibration.load(path) if os.path.exists(path) else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('points', help='JSON file of [[px, py], [rx, ry]] reference points')
+    parser.add_argument('output', help='where to save the calibration')
+    parser.add_argument('--affine', action='store_true', help='fit an affine transform instead of a homography')
+    args = parser.parse_args()
+
+    with open(args.points) as f:
+        pairs = json.load(f)
+
+    result = Calibration.from_points([pixel for pixel, _ in pairs], [position for _, position in pairs],
+                                     'affine' if args.affine else 'homography')
+    result.save(args.output)
+
+    print(f'Saved {result.model} calibration from {len(pairs)} points to {args.output}, '
+          f'error {result.error * 1000:.1f} mm')
@@ -1,16 +1,119 @@
 from __future__ import annotations
 
-import urllib.request
 import cv2
 import time
 import numpy as np
 
-from typing import Optional, NewType
-from util import Vec2, Object
+from collections import OrderedDict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from threading import Condition, Lock, Thread
+from typing import Iterable, Optional, NewType
+
+import metrics
+import tracing
+from calibration import Calibration
+from http_client import client_for
+from tracker import ObjectTracker
+from util import Vec2, Object, PhaseTimer
 
 Image = NewType('Image', any)
 
 
+@dataclass
+class Detection:
+    """
+    Objects found in one camera frame.
+    """
+    timestamp: float
+    """`time.monotonic()` when the frame was captured"""
+    objects: dict[Object, Optional[list[Vec2]]]
+
+    def __getitem__(self, item: Object) -> Optional[list[Vec2]]:
+        return self.objects.get(item)
+
+
+class DetectionMemo:
+    """
+    Detection results of recent frames keyed by a fingerprint of the frame, least recently used frames are dropped.
+
+    The fingerprint is the frame shrunk by `block` in both directions. A frame matches a remembered one when every
+    fingerprint pixel is within `tolerance`, so frames of a static scene match even when sensor noise makes them
+    differ, while an object that is added, moved or removed changes its blocks by far more.
+    """
+    block = 16
+    tolerance = 3
+
+    def __init__(self, size=64):
+        self.size = size
+        self.entries: OrderedDict[bytes, tuple[np.ndarray, dict[Object, Optional[list[Vec2]]]]] = OrderedDict()
+        """Results per object of every remembered frame, keyed by the bytes of its fingerprint"""
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def fingerprint(self, img: Image) -> np.ndarray:
+        return cv2.resize(img, None, fx=1 / self.block, fy=1 / self.block, interpolation=cv2.INTER_AREA)
+
+    def _find(self, fingerprint: np.ndarray) -> Optional[bytes]:
+        key = fingerprint.tobytes()
+
+        if key in self.entries:
+            return key
+
+        for key, (known, _) in reversed(self.entries.items()):
+            if known.shape == fingerprint.shape and \
+                    np.abs(known.astype(np.int16) - fingerprint).max() <= self.tolerance:
+                return key
+
+        return None
+
+    def lookup(self, fingerprint: np.ndarray, obj: Object) -> tuple[bool, Optional[list[Vec2]]]:
+        """
+        `(True, result)` when `obj` has been detected in a matching frame, otherwise `(False, None)`.
+        """
+        with self.lock:
+            key = self._find(fingerprint)
+
+            if key is not None and obj in self.entries[key][1]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key][1][obj]
+
+            self.misses += 1
+            return False, None
+
+    def store(self, fingerprint: np.ndarray, obj: Object, result: Optional[list[Vec2]]):
+        with self.lock:
+            key = self._find(fingerprint)
+
+            if key is None:
+                key = fingerprint.tobytes()
+                self.entries[key] = fingerprint, {}
+
+            self.entries[key][1][obj] = result
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __repr__(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+
+        return f'DetectionMemo({len(self.entries)}/{self.size} frames, {self.hits} hits, {self.misses} misses, ' \
+               f'{rate:.0%} hit rate)'
+
+
+capture_seconds = metrics.histogram('camera_capture_seconds', 'Time to get and decode a frame', ['camera'])
+detect_seconds = metrics.histogram('camera_detect_seconds', 'Time to detect objects, including getting the frame',
+                                   ['camera'])
+
+
 class NumberToLarge(Exception):
     pass
 
@@ -23,10 +126,29 @@ class NoResultException(Exception):
     pass
 
 
+class ScaleException(Exception):
+    pass
+
+
+DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+"""JPEG decode flag for every supported `scale`, the image is decoded straight to grayscale"""
+
+
 class Camera:
     """
     Camera object to interface with each robot's camera.
     """
+    min_cube_size = 25
+    """Smallest width and height of a cube, in full resolution pixels"""
+    reach_y = -0.445
+    """Objects with a smaller y are out of reach of the robot"""
+    switch_wait = 3.0
+    """Time the camera is given to load a bank after a switch, the camera does not confirm it"""
 
     def __init__(self,
                  ip: str,
@@ -35,15 +157,45 @@ class Camera:
                  invert: Vec2,
                  camera_cut: tuple[Vec2, Vec2],
                  camera_threshold: int,
-                 objects: list[Object]):
+                 objects: list[Object],
+                 max_age=0.0,
+                 scale=1,
+                 calibration: Optional[Calibration] = None,
+                 memo_size=0,
+                 track=False):
+        """
+        `max_age` is how many seconds a captured frame, and what was detected in it, is reused.
+        The cache is cleared with `invalidate`, when the scene has been changed.
+
+        `scale` decodes the images at 1/2, 1/4 or 1/8 resolution. Detections are still in full resolution
+        coordinates.
+
+        `calibration` maps pixels to robot coordinates, without it the hand-tuned `offsets`, `offset_scale` and
+        `invert` are used.
+
+        `memo_size` is how many detection results of recent frames are remembered, see `DetectionMemo`.
+
+        With `track` the objects found are kept between frames and only the changed parts of a frame are searched,
+        see `ObjectTracker`.
+        """
         self.ip = ip
         self.offset = offsets
         self.offset_scale = offset_scale
         self.invert = invert
+
+        self.calibration = calibration or Calibration.from_offsets(offsets, offset_scale, invert)
+        self.cube_anchor = np.array([0.5, 0.5]) if calibration else \
+            np.array([1 / (2 * offset_scale.x * invert.x), 1 / (2 * offset_scale.y * invert.y)])
+        """
+        Point of a cube's bounding box that is transformed to its position, as a fraction of the box size.
+        The hand-tuned offsets were tuned with half the box size added after scaling, this anchor keeps that.
+        """
         self.camera_cut = camera_cut
         self.objects = objects
 
         self.switch_counter = 0
+        self.bank: Optional[int] = None
+        """Active bank, `None` until the first `switch_object`"""
         self.witch_object = 0
         self.object_located = 0
 
@@ -52,6 +204,50 @@ class Camera:
 
         self.camera_threshold = camera_threshold
 
+        if scale not in DECODE_FLAGS:
+            raise ScaleException(f'scale needs to be one of {list(DECODE_FLAGS)}, current value is {scale}')
+
+        self.scale = scale
+        self.decode_flag = DECODE_FLAGS[scale]
+
+        x, y = camera_cut[0].to_tuple()
+        h, w = camera_cut[1].to_tuple()
+        self.roi = slice(x // scale, w // scale), slice(y // scale, h // scale)
+        """`camera_cut` in decoded image pixels"""
+
+        self.memo = DetectionMemo(memo_size) if memo_size else None
+
+        self.trackers: Optional[dict[Object, ObjectTracker]] = None
+        if track:
+            self.trackers = {Object.CUBE: ObjectTracker(self.find_cubes, scale),
+                             Object.CYLINDER: ObjectTracker(self.find_cylinders, scale)}
+
+        self.timings: Optional[PhaseTimer] = None
+        """When set, the time of every decode and detection stage is recorded, see `stage`"""
+
+        self.detect_lock = Lock()
+        """Held by the detectors while they use the scratch buffers"""
+        self._scratch: dict[str, np.ndarray] = {}
+
+        self.http = client_for(f'http://{ip}', timeout=2.0)
+
+        self.max_age = max_age
+        self.cache_lock = Lock()
+        self._frame: Optional[tuple[float, Image]] = None
+        self._results: dict[Object, Optional[list[Vec2]]] = {}
+        """Detection results for `_frame`"""
+        self._invalidated_at = 0.0
+        """Frames captured before this time are not used, set by `invalidate`"""
+
+        self.capturing = False
+        self.capture_rate = 10.0
+        self.capture_errors = 0
+        self.frame_ready = Condition(self.cache_lock)
+        self._buffers: list[Optional[tuple[float, Image]]] = [None, None]
+        """Front and back frame of the capture thread, `_front` is the index of the front frame"""
+        self._front = 0
+        self._capture_thread: Optional[Thread] = None
+
         # TODO: Actually ping the camera to see if it responds.
 
     @staticmethod
@@ -66,113 +262,340 @@ class Camera:
             cv2.waitKey(0)
             cv2.destroyAllWindows()
 
+    @tracing.traced()
     def get_image(self) -> Image:
-        req = urllib.request.urlopen(f'http://{self.ip}/LiveImage.jpg')
-        arr = np.asarray(bytearray(req.read()), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
+        start = time.perf_counter()
+        res = self.http.get('/LiveImage.jpg')
+        img = self.decode(res.content)
+        capture_seconds.observe(time.perf_counter() - start, camera=self.ip)
 
-        x, y = self.camera_cut[0].to_tuple()
-        h, w = self.camera_cut[1].to_tuple()
+        return img
 
-        img = img[x:w, y:h]
+    def decode(self, data: bytes) -> Image:
+        """
+        Decode a JPEG from the camera to a grayscale image cut to `camera_cut`.
 
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        The JPEG is decoded straight to grayscale at `scale`, and the cut is a view into the decoded image, so there
+        is no color image and no copy.
+        """
+        with self.stage('decode'):
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), self.decode_flag)
 
-        return img
+        if img is None:
+            raise NoResultException(f'Camera {self.ip}: could not decode the image')
 
-    def image_to_threshold(self, image: Image) -> Image:
-        return cv2.threshold(image, self.camera_threshold, 255, cv2.THRESH_BINARY)[1]
+        return img[self.roi]
 
-    def image_coords_to_robot_coords(self, x: int | float, y: int | float) -> tuple[float, float]:
-        x = ((x + self.offset.x) * self.invert.x) * self.offset_scale.x
-        y = ((y + self.offset.y) * self.invert.y) * self.offset_scale.y
+    def stage(self, name: str):
+        """
+        Context manager that records the time of a pipeline stage in `timings`, does nothing when it is not set.
+        """
+        return self.timings.phase(name) if self.timings else nullcontext()
 
-        return x, y
+    def scratch(self, name: str, like: np.ndarray) -> np.ndarray:
+        """
+        Buffer with the shape and type of `like`, reused across frames. Only use while holding `detect_lock`.
+        """
+        buffer = self._scratch.get(name)
 
-    def get_cubes(self) -> Optional[list[Vec2]]:
-        img = self.get_image()
+        if buffer is None or buffer.shape != like.shape or buffer.dtype != like.dtype:
+            buffer = self._scratch[name] = np.empty_like(like)
 
-        threshold = self.image_to_threshold(img)
+        return buffer
 
-        contours, hierarchy = cv2.findContours(threshold, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    def get_frame(self, max_age: Optional[float] = None) -> tuple[float, Image]:
+        """
+        Capture time and image. The last frame is reused while it is younger than `max_age`, default `self.max_age`.
+        While the capture thread runs the latest frame it has taken is returned instead, see `start_capture`.
+        """
+        if self.capturing:
+            return self.latest_frame()
 
-        cubes = []
+        max_age = self.max_age if max_age is None else max_age
 
-        for cnt in contours:
-            x1, y1 = cnt[0][0]
-            approx = cv2.approxPolyDP(cnt, 0.04 * cv2.arcLength(cnt, True), True)
-            if len(approx) == 4:
-                x, y, w, h = cv2.boundingRect(cnt)
+        with self.cache_lock:
+            if self._frame and time.monotonic() - self._frame[0] <= max_age:
+                return self._frame
 
-                if w < 25 or h < 25:
-                    continue
+        timestamp = time.monotonic()
+        frame = timestamp, self.get_image()
 
-                x, y = self.image_coords_to_robot_coords(x, y)
+        with self.cache_lock:
+            if timestamp >= self._invalidated_at:
+                self._frame = frame
+                self._results = {}
 
-                cube = Vec2(((y + (h / 2)) * self.invert.x) / 1000, ((x + (w / 2)) * self.invert.y) / 1000)
+        return frame
 
-                if cube.y < -0.445:
-                    print(f'Cube out of reach: {cube=}')
-                    continue
+    @tracing.traced()
+    def latest_frame(self, timeout=5.0) -> tuple[float, Image]:
+        """
+        Front frame of the capture thread. Only waits when there is no frame taken after the last `invalidate`.
+        """
+        def fresh() -> bool:
+            frame = self._buffers[self._front]
+            return frame is not None and frame[0] >= self._invalidated_at
 
-                cubes.append(cube)
+        with self.frame_ready:
+            if not self.frame_ready.wait_for(lambda: fresh() or not self.capturing, timeout) or not fresh():
+                raise NoResultException(f'Camera {self.ip}: no new frame within {timeout}s')
 
-        return cubes if len(cubes) > 0 else None
+            frame = self._buffers[self._front]
 
-    def get_cylinders(self) -> Optional[list[Vec2]]:
-        img = self.get_image()
-        img = cv2.blur(img, (3, 3))
-        circles = cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 20,
-                                   param1=50,
-                                   param2=30,
-                                   minRadius=1,
-                                   maxRadius=40
-                                   )
+            if frame is not self._frame:
+                self._frame = frame
+                self._results = {}
 
-        cylinders = []
+            return frame
 
-        if circles is not None:
-            circles = np.uint16(np.around(circles))
+    def invalidate(self):
+        """
+        Drop the cached frame and detections, the next query uses an image captured after this call and detects
+        again instead of reusing the results of a matching frame from `memo`.
+        """
+        with self.cache_lock:
+            self._frame = None
+            self._results = {}
+            self._invalidated_at = time.monotonic()
+
+        if self.memo is not None:
+            self.memo.clear()
+
+    def start_capture(self, rate: Optional[float] = None):
+        """
+        Capture continuously from a background thread, `rate` is frames per second.
+
+        The thread fetches, decodes, crops and converts into the back buffer, then swaps it with the front buffer.
+        `get_frame` and `detect` use the front frame, so callers never wait on the network.
+        """
+        if rate is not None:
+            self.capture_rate = rate
+
+        if self.capturing:
+            return self
+
+        self.capturing = True
+        self._capture_thread = Thread(target=self._capture, name=f'camera_{self.ip}', daemon=True)
+        self._capture_thread.start()
+
+        return self
+
+    def stop_capture(self):
+        self.capturing = False
+
+        with self.frame_ready:
+            self.frame_ready.notify_all()
+
+        if self._capture_thread:
+            self._capture_thread.join()
+            self._capture_thread = None
+
+    def _capture(self):
+        period = 1 / self.capture_rate
+
+        while self.capturing:
+            start = time.monotonic()
+
+            try:
+                img = self.get_image()
+            except Exception as e:
+                self.capture_errors += 1
+                print(f'Camera {self.ip}: capture failed ({e})')
+            else:
+                back = 1 - self._front
+                self._buffers[back] = start, img
+
+                with self.frame_ready:
+                    self._front = back
+                    self.frame_ready.notify_all()
+
+            time.sleep(max(0.0, period - (time.monotonic() - start)))
+
+    def image_to_threshold(self, image: Image, dst: Optional[np.ndarray] = None) -> Image:
+        return cv2.threshold(image, self.camera_threshold, 255, cv2.THRESH_BINARY, dst)[1]
+
+    def to_robot(self, pixels: np.ndarray) -> list[Vec2]:
+        """
+        Robot positions of full resolution pixels within reach, transformed together.
+        """
+        positions = []
+
+        for position in map(Vec2, *self.calibration.transform(pixels).T.tolist()):
+            if position.y < self.reach_y:
+                print(f'Object out of reach: {position=}')
+                continue
+
+            positions.append(position)
+
+        return positions
+
+    def get_cubes(self, img: Optional[Image] = None) -> Optional[list[Vec2]]:
+        """
+        Find cubes in `img`, captures a new image if none is given.
+        """
+        if img is None:
+            img = self.get_image()
+
+        return self.to_robot(self.positions(Object.CUBE, self.find_cubes(img))) or None
+
+    def positions(self, obj: Object, boxes: np.ndarray) -> np.ndarray:
+        """
+        Full resolution pixel position of every object from its bounding box.
+        """
+        if obj == Object.CUBE:
+            return boxes[:, :2] + (boxes[:, 2:] - boxes[:, :2]) * self.cube_anchor
+
+        return (boxes[:, :2] + boxes[:, 2:]) / 2
+
+    def find_cubes(self, img: Image) -> np.ndarray:
+        """
+        Full resolution bounding box `(x0, y0, x1, y1)` of every cube in `img`, relative to the corner of `img`.
+        """
+        with self.detect_lock:
+            with self.stage('threshold'):
+                threshold = self.image_to_threshold(img, self.scratch('threshold', img))
+
+            with self.stage('contours'):
+                contours, hierarchy = cv2.findContours(threshold, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+        with self.stage('cube_filter'):
+            return self.filter_cubes(contours)
+
+    def filter_cubes(self, contours: tuple[np.ndarray, ...]) -> np.ndarray:
+        """
+        Full resolution bounding boxes of the cubes among `contours`.
+
+        The bounding box of every contour is found in one pass over all contour points, and only contours at least
+        `min_cube_size` wide and high are approximated as polygons.
+        """
+        if not contours:
+            return np.empty((0, 4))
+
+        lengths = np.fromiter((len(cnt) for cnt in contours), dtype=np.intp, count=len(contours))
+        starts = np.concatenate(([0], np.cumsum(lengths[:-1])))
+        points = np.concatenate(contours).reshape(-1, 2)
+
+        boxes = np.hstack([np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts) + 1]) * self.scale
+
+        candidates = np.flatnonzero((boxes[:, 2:] - boxes[:, :2] >= self.min_cube_size).all(axis=1))
+        candidates = [i for i in candidates
+                      if len(cv2.approxPolyDP(contours[i], 0.04 * cv2.arcLength(contours[i], True), True)) == 4]
+
+        return boxes[candidates].reshape(-1, 4)
+
+    def get_cylinders(self, img: Optional[Image] = None) -> Optional[list[Vec2]]:
+        """
+        Find cylinders in `img`, captures a new image if none is given.
+        """
+        if img is None:
+            img = self.get_image()
+
+        return self.to_robot(self.positions(Object.CYLINDER, self.find_cylinders(img))) or None
+
+    def find_cylinders(self, img: Image) -> np.ndarray:
+        """
+        Full resolution bounding box `(x0, y0, x1, y1)` of every cylinder in `img`, relative to the corner of `img`.
+        """
+        with self.detect_lock:
+            with self.stage('blur'):
+                img = cv2.blur(img, (3, 3), self.scratch('blur', img))
+
+            with self.stage('hough'):
+                circles = cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 20 / self.scale,
+                                           param1=50,
+                                           param2=30,
+                                           minRadius=1,
+                                           maxRadius=max(1, 40 // self.scale)
+                                           )
 
-            for pt in circles[0, :]:
-                a, b, r = pt[0], pt[1], pt[2]
+        if circles is None:
+            return np.empty((0, 4))
 
-                a, b = self.image_coords_to_robot_coords(a, b)
+        centers, radii = np.around(circles[0, :, :2]) * self.scale, circles[0, :, 2:3] * self.scale
 
-                cylinder = Vec2((b / 1000) * self.invert.x, (a / 1000) * self.invert.y)
+        return np.hstack([centers - radii, centers + radii])
 
-                if cylinder.y < -0.445:
-                    print(f'Cylinder out of reach: {b}, {a}')
+    @tracing.traced()
+    def detect(self, objects: Optional[Iterable[Object]] = None, max_age: Optional[float] = None) -> Detection:
+        """
+        Run the detector of every object on one image. Defaults to the camera's `objects`.
+        Frames and detections younger than `max_age` are reused, see `get_frame`, and with a `memo` so are the
+        detections of a frame that looks the same as a recent one.
+        """
+        start = time.perf_counter()
+        timestamp, img = self.get_frame(max_age)
+
+        found = {}
+        fingerprint = None
+
+        for obj in objects or self.objects:
+            with self.cache_lock:
+                current = self._frame is not None and self._frame[0] == timestamp
+
+                if current and obj in self._results:
+                    found[obj] = self._results[obj]
                     continue
 
-                cylinders.append(cylinder)
+            if self.memo is None:
+                found[obj] = self.run_detector(obj, img)
+            else:
+                if fingerprint is None:
+                    with self.stage('fingerprint'):
+                        fingerprint = self.memo.fingerprint(img)
+
+                known, found[obj] = self.memo.lookup(fingerprint, obj)
 
-        return cylinders if len(cylinders) > 0 else None
+                if not known:
+                    found[obj] = self.run_detector(obj, img)
+                    self.memo.store(fingerprint, obj, found[obj])
+
+            with self.cache_lock:
+                if current and self._frame is not None and self._frame[0] == timestamp:
+                    self._results[obj] = found[obj]
+
+        detect_seconds.observe(time.perf_counter() - start, camera=self.ip)
+
+        return Detection(timestamp, found)
+
+    def run_detector(self, obj: Object, img: Image) -> Optional[list[Vec2]]:
+        if self.trackers:
+            return self.to_robot(self.positions(obj, self.trackers[obj].update(img))) or None
+
+        return self.get_cubes(img) if obj == Object.CUBE else self.get_cylinders(img)
 
     def get_shapes(self) -> tuple[Optional[list[Vec2]], Optional[list[Vec2]]]:
-        return self.get_cubes(), self.get_cylinders()
+        detection = self.detect([Object.CUBE, Object.CYLINDER])
+
+        return detection[Object.CUBE], detection[Object.CYLINDER]
 
     def get_object(self, _object: Object) -> Optional[list[Vec2]]:
-        return self.get_cubes() if _object == Object.CUBE else self.get_cylinders()
+        return self.detect([_object])[_object]
 
-    def switch_object(self, bank: int):
+    @tracing.traced()
+    def switch_object(self, bank: int, force=False):
         """
         Switch what object the camera detects.
 
         In theory, it changes what locator it uses. So `INT_1_0` is the first object locator in the camera. That means
         that `INT_1_1` is the second object locator.
 
-        TODO: Change function to take channel as parameter to change to a specific object locator.
+        Nothing is sent when `bank` is already active, unless `force` is set.
+
         TODO: Make `switch_counter` be of type `Object` insteadof `int`.
         """
-        res = urllib.request.urlopen(f'http://10.1.1.8/CmdChannel?sINT_1_{bank}')
+        if bank == self.bank and not force:
+            return
+
+        res = self.http.get(f'/CmdChannel?sINT_1_{bank}')
 
-        if 'Ref bank index is not used.' in res.read().decode():
+        if 'Ref bank index is not used.' in res.text:
             raise BankException('Change to empty bank. There are not that many object locators created, try a lower '
-                                'number. bang = {bank}')
+                                f'number. bank = {bank}')
 
-        time.sleep(3)
+        time.sleep(self.switch_wait)
 
+        self.bank = bank
         self.witch_object = self.objects[bank]
+        self.invalidate()
 
         print(f"Camera {self.ip}: object switched to {self.witch_object}")
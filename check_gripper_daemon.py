@@ -0,0 +1,92 @@
+"""
+Checks the socket round trip of `GripperDaemon` against `FakeGripperController`, without a robot.
+
+    python check_gripper_daemon.py
+
+Exits with an `AssertionError` at the first reply or command that is not what the robot would get.
+"""
+import socket
+import time
+
+from gripper_daemon import DaemonCommand, DaemonException, FakeGripperController, GripperDaemon, encode
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_received(controller: FakeGripperController, count: int, timeout=2.0):
+    deadline = time.monotonic() + timeout
+
+    while len(controller.commands) < count:
+        assert time.monotonic() < deadline, f'{count} commands expected, got {controller.commands}'
+        time.sleep(0.001)
+
+
+def check_encode():
+    assert encode(DaemonCommand.OPEN) == b'(1.000000' + b',0.000000' * 9 + b')\n'
+    assert encode(DaemonCommand.MOVE, 255) == b'(3.000000,255.000000' + b',0.000000' * 8 + b')\n'
+
+    try:
+        encode(DaemonCommand.MOVEL, *range(10))
+    except DaemonException:
+        pass
+    else:
+        raise AssertionError('10 arguments must not fit in a message')
+
+
+def check_round_trip():
+    controller = FakeGripperController(object_detected=True)
+    daemon = GripperDaemon(controller, host='127.0.0.1', port=free_port(), timeout=2.0)
+
+    try:
+        daemon.install()
+        assert daemon.installs == 1 and daemon.connected
+        assert len(controller.programs) == 1 and 'socket_open("127.0.0.1"' in controller.programs[0]
+
+        assert daemon.command(DaemonCommand.OPEN) == 'ok'
+        assert controller.commands[-1] == (DaemonCommand.OPEN, (0.0,) * 9)
+
+        assert daemon.command(DaemonCommand.CLOSE_AND_WAIT) == '1'
+        controller.object_detected = False
+        assert daemon.command(DaemonCommand.IS_OBJECT_DETECTED) == '0'
+
+        pose = (0.1, -0.2, 0.3, 0.0, 3.14, 0.0, 1.2, 0.25, 0.02)
+        assert daemon.command(DaemonCommand.MOVEL, *pose) == 'ok'
+        assert controller.commands[-1] == (DaemonCommand.MOVEL, pose)
+
+        # Queued commands are answered in order, the replies are read before the next reply
+        for _ in range(3):
+            assert daemon.command(DaemonCommand.MOVEJ, *pose, wait=False) is None
+        assert daemon.pending_replies == 3
+
+        daemon.wait()
+        assert daemon.pending_replies == 0
+        assert daemon.command(DaemonCommand.SET_SPEED, 255) == 'ok'
+        assert controller.commands[-1] == (DaemonCommand.SET_SPEED, (255.0,) + (0.0,) * 8)
+
+        # Secondary programs run beside the daemon, queued replies are still waiting to be read
+        assert daemon.command(DaemonCommand.MOVEJ, *pose, wait=False) is None
+        controller.send_program('sec set_out():\n  set_standard_digital_out(7, True)\nend\n')
+        assert daemon.wait() == 'ok' and daemon.installs == 1
+
+        # Another program stops the daemon, the next command installs it again
+        controller.send_program('set_digital_out(7, False)')
+        assert daemon.command(DaemonCommand.OPEN) == 'ok'
+        assert daemon.installs == 2
+
+        received = len(controller.commands)
+    finally:
+        daemon.close()
+
+    wait_until_received(controller, received + 1)
+    assert controller.commands[-1][0] == DaemonCommand.STOP
+    assert not daemon.connected
+
+
+if __name__ == '__main__':
+    check_encode()
+    check_round_trip()
+    print('Gripper daemon round trip OK')
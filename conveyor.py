@@ -1,14 +1,23 @@
 import operator
 import time
 from threading import Lock
-from typing import Optional
-
-import requests
+from typing import Iterable, Optional
 
+import iolink
+import metrics
+import tracing
+from http_client import HttpClient, client_for
+from iolink import PortReading
 from robot import Robot
+from sensors import SensorPoller
 from util import Status, Direction
 
 
+starts = metrics.counter('conveyor_starts_total', 'Times the conveyor was started', ['direction'])
+detect_wait_seconds = metrics.histogram('conveyor_detect_wait_seconds', 'Time waited for an object at a sensor',
+                                        ['sensor'], buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
 class Conveyor:
     """
     Static class for handling the conveyor.
@@ -28,8 +37,14 @@ class Conveyor:
     """Wait after sensor 2 has detected the object"""
 
     dist_to_wall = 50
+    iolink_url = 'http://10.1.1.9'
+    """IO-Link master the sensors are connected to"""
+    http: HttpClient = client_for(iolink_url, timeout=0.5)
+    sensors: Optional[SensorPoller] = None
+    """When set, sensor readings come from the poller instead of a request per reading"""
     robot: Robot = None
-    lock: Lock = None
+    lock = Lock()
+    """Keeps the output pulses apart. Not the robot lock, `Robot.move_path` holds that for a whole path"""
     status = Status.READY
     move_direction = Direction.NONE
 
@@ -40,24 +55,55 @@ class Conveyor:
         print('Conveyor:', message)
 
     @staticmethod
+    @tracing.traced()
     def get_distance(sensor: int) -> Optional[float]:
         """
         Change port[n] to change sensor. 1 is closest to the door, 4 is the furthest away from the door.
         If sensors return `out of range` returns 0, because it makes the code simpler.
+        Returns the latest reading from `Conveyor.sensors` when it is running.
         """
-        r = requests.post('http://10.1.1.9', json={"code": "request", "cid": 1, "adr": "/getdatamulti", "data": {
-            "datatosend": [f"/iolinkmaster/port[{sensor}]/iolinkdevice/pdin"]
-        }})
-        res = r.json()
-        res1 = res['data']
-        data = str(res1)
-
-        if data[53] == "2":
-            d = data[68] + data[69]
-            return int(d, 16)
-        else:
+        if Conveyor.sensors and (distance := Conveyor.sensors.get_distance(sensor)) is not None:
+            return distance
+
+        reading = Conveyor.read_ports([sensor])[sensor]
+
+        if not reading.in_range:
             print("out of range")
-            return 0
+
+        return reading.distance if reading.in_range else 0
+
+    @staticmethod
+    @tracing.traced()
+    def read_ports(ports: Iterable[int]) -> dict[int, PortReading]:
+        """
+        Read any set of ports with one request to the IO-Link master.
+        """
+        r = Conveyor.http.post('/', json=iolink.request(ports), endpoint='/getdatamulti')
+
+        return iolink.decode_response(r.json())
+
+    @staticmethod
+    def get_distances(sensors: Iterable[int] = (1, 2, 3, 4)) -> dict[int, float]:
+        """
+        Read several sensors with one request. Like `get_distance` a sensor that is out of range returns 0.
+        """
+        return {port: reading.distance if reading.in_range else 0
+                for port, reading in Conveyor.read_ports(sensors).items()}
+
+    @staticmethod
+    def start_sensors(rate=20.0) -> SensorPoller:
+        """
+        Start reading all sensors in the background, see `SensorPoller`.
+        """
+        Conveyor.sensors = SensorPoller(Conveyor.get_distances, rate=rate).start()
+
+        return Conveyor.sensors
+
+    @staticmethod
+    def stop_sensors():
+        if Conveyor.sensors:
+            Conveyor.sensors.stop()
+            Conveyor.sensors = None
 
     @staticmethod
     def start_right():
@@ -66,7 +112,8 @@ class Conveyor:
         """
         Conveyor.move_direction = Direction.RIGHT
         Conveyor.log('Started to move right')
-        with Conveyor.lock:
+        starts.inc(direction=Direction.RIGHT.name)
+        with tracing.locked(Conveyor.lock, 'conveyor lock'):
             Conveyor.robot.set_digital_out(5, 1)
             # allow digital out 5 to stay active for 0.1s
             time.sleep(0.1)
@@ -82,7 +129,8 @@ class Conveyor:
         """
         Conveyor.move_direction = Direction.LEFT
         Conveyor.log('Started to move left')
-        with Conveyor.lock:
+        starts.inc(direction=Direction.LEFT.name)
+        with tracing.locked(Conveyor.lock, 'conveyor lock'):
             Conveyor.robot.set_digital_out(6, 1)
             # allow digital out 6 to stay active for 0.1s
             time.sleep(0.1)
@@ -96,7 +144,7 @@ class Conveyor:
         """
         Stops the conveyor.
         """
-        with Conveyor.lock:
+        with tracing.locked(Conveyor.lock, 'conveyor lock'):
             Conveyor.robot.set_digital_out(7, 1)
             # allow digital out 7 to stay active for 0.1s
             time.sleep(0.1)
@@ -113,24 +161,38 @@ class Conveyor:
         Sets the speed of the conveyor. The speed is given in voltage
         """
         # sets analog out to voltage instead of current
-        with Conveyor.lock:
-            Conveyor.robot.send_program("set_analog_outputdomain(1, 1)")
+        with tracing.locked(Conveyor.lock, 'conveyor lock'):
             # sets analog out 1 to desired voltage. 0.012 is the slowest speed.
-            Conveyor.robot.set_analog_out(1, voltage)
+            Conveyor.robot.set_analog_out(1, voltage, domain=1)
 
         return Conveyor
 
     @staticmethod
+    @tracing.traced()
     def block_for_detect_object(sensor: int, compare=operator.gt, debug_print=False):
         """
         Blocks the thread while waiting for something to move past the given sensor.
         operator.gt = >
         operator.lt = <
         """
+        start = time.monotonic()
+
+        if Conveyor.sensors:
+            reading = Conveyor.sensors.wait_for(sensor, lambda dist: not compare(dist, Conveyor.dist_to_wall))
+
+            if debug_print:
+                print('dist =', reading.distance)
+
+            Conveyor.log(f'Sensor ({sensor}) detected block')
+            detect_wait_seconds.observe(time.monotonic() - start, sensor=sensor)
+
+            return Conveyor
+
         while compare(dist := Conveyor.get_distance(sensor), Conveyor.dist_to_wall):
             if debug_print:
                 print('dist =', dist)
 
         Conveyor.log(f'Sensor ({sensor}) detected block')
+        detect_wait_seconds.observe(time.monotonic() - start, sensor=sensor)
 
         return Conveyor
\ No newline at end of file
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import re
+import socket
+import time
+from enum import Enum
+from threading import Lock, Thread
+from typing import Optional
+
+from Gripper import preamble
+
+SOCKET_NAME = 'gripper_daemon'
+MESSAGE_LENGTH = 10
+"""Every message is `(command, arg1, ..., arg9)`, unused arguments are sent as 0"""
+
+
+class DaemonException(Exception):
+    pass
+
+
+class DaemonCommand(Enum):
+    STOP = 0
+    OPEN = 1
+    CLOSE = 2
+    MOVE = 3
+    SET_FORCE = 4
+    SET_SPEED = 5
+    ACTIVATE = 6
+    IS_OBJECT_DETECTED = 7
+    MOVEJ = 8
+    MOVEL = 9
+    OPEN_AND_WAIT = 12
+    CLOSE_AND_WAIT = 13
+    ACTIVATE_AND_WAIT = 14
+
+
+DAEMON_SCRIPT = """  while (not socket_open("{host}", {port}, "{name}")):
+    sleep(0.1)
+  end
+  daemon_running = True
+  while (daemon_running):
+    msg = socket_read_ascii_float({length}, "{name}")
+    if (msg[0] == {length}):
+      cmd = msg[1]
+      reply = "ok"
+      if (cmd == 0):
+        daemon_running = False
+      elif (cmd == 1):
+        rq_open()
+      elif (cmd == 2):
+        rq_close()
+      elif (cmd == 3):
+        rq_move(floor(msg[2]))
+      elif (cmd == 4):
+        rq_set_force(floor(msg[2]))
+      elif (cmd == 5):
+        rq_set_speed(floor(msg[2]))
+      elif (cmd == 6):
+        rq_activate()
+      elif (cmd == 7 or cmd == 12 or cmd == 13):
+        if (cmd == 12):
+          rq_open_and_wait()
+        elif (cmd == 13):
+          rq_close_and_wait()
+        end
+        if (rq_is_object_detected()):
+          reply = "1"
+        else:
+          reply = "0"
+        end
+      elif (cmd == 8):
+        movej(p[msg[2], msg[3], msg[4], msg[5], msg[6], msg[7]], a=msg[8], v=msg[9], r=msg[10])
+      elif (cmd == 9):
+        movel(p[msg[2], msg[3], msg[4], msg[5], msg[6], msg[7]], a=msg[8], v=msg[9], r=msg[10])
+      elif (cmd == 14):
+        rq_activate_and_wait()
+      else:
+        reply = "unknown"
+      end
+      socket_send_line(reply, "{name}")
+    end
+  end
+  socket_close("{name}")
+end"""
+
+
+def daemon_program(host: str, port: int) -> str:
+    """
+    The gripper preamble followed by a loop that executes commands read from `host:port`.
+    """
+    return preamble() + DAEMON_SCRIPT.format(host=host, port=port, name=SOCKET_NAME, length=MESSAGE_LENGTH)
+
+
+def encode(command: DaemonCommand, *args: float) -> bytes:
+    values = [command.value, *args]
+
+    if len(values) > MESSAGE_LENGTH:
+        raise DaemonException(f'{command.name} takes at most {MESSAGE_LENGTH - 1} arguments, got {len(args)}')
+
+    values += [0] * (MESSAGE_LENGTH - len(values))
+
+    return ('(' + ','.join(f'{float(value):.6f}' for value in values) + ')\n').encode()
+
+
+def local_ip_for(host: str) -> str:
+    """
+    The address of the interface this machine uses to reach `host`. Nothing is sent.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.connect((host, 9))
+        return s.getsockname()[0]
+
+
+class GripperDaemon:
+    """
+    Long-running URScript program on the robot that executes gripper (and motion) commands sent over a socket.
+
+    The daemon is installed with a single `send_program`, after that every command is one short line.
+    Any other program sent to the robot stops the daemon, so moves are also routed through it. Secondary programs
+    (`sec`) run beside it, outputs are set with those and never wait for queued moves. If the daemon has been
+    stopped anyway it is reinstalled by the next command.
+    """
+
+    def __init__(self, robot, host: Optional[str] = None, port=50001, timeout=5.0):
+        self.robot = robot
+        self.host = host if host else local_ip_for(robot.host)
+        self.port = port
+        self.timeout = timeout
+        self.lock = Lock()
+        self.installs = 0
+
+        self.pending_replies = 0
+        """Replies for commands sent with `wait=False` that have not been read yet"""
+
+        self._server: Optional[socket.socket] = None
+        self._conn: Optional[socket.socket] = None
+        self._reader = None
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    def install(self):
+        """
+        Send the daemon program to the robot and wait for it to connect back.
+        """
+        if self._server is None:
+            self._server = socket.create_server(('', self.port))
+
+        self._disconnect()
+        self._server.settimeout(self.timeout)
+
+        self.robot.send_program(daemon_program(self.host, self.port))
+
+        try:
+            conn, _ = self._server.accept()
+        except socket.timeout:
+            raise DaemonException(f'Robot did not connect to {self.host}:{self.port} within {self.timeout}s')
+
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._conn = conn
+        self._reader = conn.makefile('rb')
+        self.pending_replies = 0
+        self.installs += 1
+
+    def command(self, command: DaemonCommand, *args: float, wait=True, timeout: Optional[float] = None) \
+            -> Optional[str]:
+        """
+        Send a command. With `wait` returns the reply once the robot has executed it, otherwise returns at once.
+        Commands sent without `wait` are queued on the robot, so consecutive blended moves are not stopped
+        between.
+        """
+        message = encode(command, *args)
+
+        with self.lock:
+            for attempt in range(2):
+                if not self.connected:
+                    self.install()
+
+                try:
+                    self._conn.sendall(message)
+
+                    if not wait:
+                        self.pending_replies += 1
+                        return None
+
+                    self._drain(timeout)
+                    return self._read_reply(timeout)
+                except socket.timeout:
+                    self._disconnect()
+                    raise DaemonException(f'No reply to {command.name} from the gripper daemon')
+                except OSError:
+                    # The daemon was stopped by another program, reinstall and try once more
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Wait for commands sent with `wait=False` to finish. Returns the reply to the last one, `None` if there was
+        nothing to wait for.
+        """
+        with self.lock:
+            if not self.connected:
+                return None
+
+            try:
+                return self._drain(timeout)
+            except socket.timeout:
+                self._disconnect()
+                raise DaemonException('No reply to the queued commands from the gripper daemon')
+
+    def close(self):
+        with self.lock:
+            if self.connected:
+                try:
+                    self._conn.sendall(encode(DaemonCommand.STOP))
+                except OSError:
+                    pass
+
+            self._disconnect()
+
+            if self._server is not None:
+                self._server.close()
+                self._server = None
+
+    def _drain(self, timeout: Optional[float]) -> Optional[str]:
+        reply = None
+
+        while self.pending_replies:
+            reply = self._read_reply(timeout)
+            self.pending_replies -= 1
+
+        return reply
+
+    def _read_reply(self, timeout: Optional[float]) -> str:
+        self._conn.settimeout(timeout if timeout is not None else self.timeout)
+        line = self._reader.readline()
+
+        if not line:
+            raise ConnectionResetError('Gripper daemon closed the connection')
+
+        return line.decode().strip()
+
+    def _disconnect(self):
+        if self._reader is not None:
+            self._reader.close()
+        if self._conn is not None:
+            self._conn.close()
+
+        self._reader = None
+        self._conn = None
+        self.pending_replies = 0
+
+
+class FakeGripperController:
+    """
+    Stands in for the robot controller when testing `GripperDaemon` without hardware.
+
+    Daemon programs passed to `send_program` connect back and answer commands from a thread, secondary programs
+    are only recorded and any other program stops the running daemon the same way the real controller does.
+    """
+
+    def __init__(self, host='127.0.0.1', object_detected=False, command_delay=0.0):
+        self.host = host
+        self.object_detected = object_detected
+        self.command_delay = command_delay
+        self.commands: list[tuple[DaemonCommand, tuple[float, ...]]] = []
+        self.programs: list[str] = []
+
+        self._conn: Optional[socket.socket] = None
+
+    def send_program(self, prog: str):
+        self.programs.append(prog)
+
+        if prog.startswith('sec '):
+            return
+
+        if self._conn is not None:
+            self._conn.shutdown(socket.SHUT_RDWR)
+            self._conn = None
+
+        match = re.search(rf'socket_open\("([^"]+)", (\d+), "{SOCKET_NAME}"\)', prog)
+        if match:
+            self._conn = socket.create_connection((match[1], int(match[2])))
+            Thread(target=self._serve, args=(self._conn,), daemon=True).start()
+
+    def _serve(self, conn: socket.socket):
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                values = [float(value) for value in line.decode().strip()[1:-1].split(',')]
+                command = DaemonCommand(int(values[0]))
+                self.commands.append((command, tuple(values[1:])))
+
+                if command == DaemonCommand.STOP:
+                    break
+
+                time.sleep(self.command_delay)
+
+                if command in (DaemonCommand.IS_OBJECT_DETECTED, DaemonCommand.OPEN_AND_WAIT,
+                               DaemonCommand.CLOSE_AND_WAIT):
+                    reply = '1' if self.object_detected else '0'
+                else:
+                    reply = 'ok'
+
+                conn.sendall(f'{reply}\n'.encode())
+
+
+if __name__ == '__main__':
+    controller = FakeGripperController()
+    daemon = GripperDaemon(controller, host='127.0.0.1')
+
+    start = time.perf_counter()
+    daemon.install()
+    print(f'Install: {(time.perf_counter() - start) * 1000:.2f} ms, {len(controller.programs[0])} bytes')
+
+    n = 1000
+    start = time.perf_counter()
+    for i in range(n):
+        daemon.command(DaemonCommand.CLOSE if i % 2 else DaemonCommand.OPEN)
+    print(f'Command round trip: {(time.perf_counter() - start) / n * 1000:.3f} ms, '
+          f'{len(encode(DaemonCommand.OPEN))} bytes')
+
+    controller.send_program('set_digital_out(7, False)')
+    daemon.command(DaemonCommand.OPEN)
+    print(f'Reinstalled after preemption: {daemon.installs == 2}')
+
+    daemon.close()
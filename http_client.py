@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+request_seconds = metrics.histogram('http_request_seconds', 'Latency of requests to the devices, including failed ones',
+                                    ['device', 'endpoint'])
+request_errors = metrics.counter('http_request_errors_total', 'Requests to the devices that failed',
+                                 ['device', 'endpoint'])
+
+
+class EndpointStats:
+    """
+    Request latency of one endpoint, the most recent `window` requests are kept for percentiles.
+    """
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def add(self, latency: float, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += latency
+        self.latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    def __repr__(self):
+        mean = self.total / self.count if self.count else 0.0
+        return f'{self.count} requests, {self.errors} errors, mean {mean * 1000:.1f} ms, ' \
+               f'p50 {self.percentile(50) * 1000:.1f} ms, p99 {self.percentile(99) * 1000:.1f} ms'
+
+
+class HttpClient:
+    """
+    HTTP client for one device. Connections are pooled and kept alive between requests, failed connections and
+    busy responses are retried.
+    """
+
+    def __init__(self, base_url: str, timeout=2.0, retries=2, backoff=0.05, pool_size=4):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            # Both the cameras and the IO-Link master only use GET and POST to read
+            allowed_methods=frozenset({'GET', 'POST'}),
+            raise_on_status=False
+        ))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats: dict[str, EndpointStats] = {}
+        self.lock = Lock()
+
+    def request(self, method: str, path: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        Send a request to `path` relative to the base url. `endpoint` names the stats entry, default is the path
+        without query.
+        """
+        endpoint = endpoint or path.split('?')[0] or '/'
+        kwargs.setdefault('timeout', self.timeout)
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+            response.raise_for_status()
+        except requests.RequestException:
+            self._record(endpoint, time.perf_counter() - start, error=True)
+            raise
+
+        self._record(endpoint, time.perf_counter() - start)
+
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def report(self) -> str:
+        with self.lock:
+            return '\n'.join(f'{self.base_url}{endpoint}: {stats}' for endpoint, stats in self.stats.items())
+
+    def close(self):
+        self.session.close()
+
+    def _record(self, endpoint: str, latency: float, error=False):
+        with self.lock:
+            self.stats.setdefault(endpoint, EndpointStats()).add(latency, error)
+
+        request_seconds.observe(latency, device=self.base_url, endpoint=endpoint)
+        if error:
+            request_errors.inc(device=self.base_url, endpoint=endpoint)
+
+
+clients: dict[str, HttpClient] = {}
+"""Shared clients by base url"""
+
+
+def client_for(base_url: str, **kwargs) -> HttpClient:
+    """
+    Shared client for `base_url`, created with `kwargs` on first use.
+    """
+    if base_url not in clients:
+        clients[base_url] = HttpClient(base_url, **kwargs)
+
+    return clients[base_url]
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterable, Optional
+
+import numpy as np
+
+PDIN_PATH = '/iolinkmaster/port[{port}]/iolinkdevice/pdin'
+
+BATCH_DTYPE = np.dtype([('port', np.uint8), ('code', np.uint16), ('distance', np.uint8), ('status', np.uint8),
+                        ('in_range', np.bool_)])
+"""Fields of the array returned by `decode_batch`"""
+
+_HEX_VALUES = np.zeros(256, dtype=np.uint16)
+for _i, _c in enumerate('0123456789abcdef'):
+    _HEX_VALUES[ord(_c)] = _HEX_VALUES[ord(_c.upper())] = _i
+
+
+class IOLinkException(Exception):
+    pass
+
+
+@dataclass
+class PortReading:
+    """
+    Result of reading one IO-Link port.
+    """
+    port: int
+    code: int
+    """Response code from the IO-Link master for the port, 2xx when the sensor answered"""
+    distance: Optional[int]
+    """`None` when the sensor is out of range"""
+    status: Optional[int] = None
+    """Low nibble of the first process data word"""
+
+    @property
+    def in_range(self) -> bool:
+        return self.distance is not None
+
+
+def request(ports: Iterable[int]) -> dict:
+    """
+    Body of a `/getdatamulti` request reading the process data of `ports`.
+    """
+    return {"code": "request", "cid": 1, "adr": "/getdatamulti", "data": {
+        "datatosend": [PDIN_PATH.format(port=port) for port in ports]
+    }}
+
+
+@lru_cache(maxsize=None)
+def port_of(path: str) -> int:
+    match = re.search(r'port\[(\d+)]', path)
+
+    if match is None:
+        raise IOLinkException(f'No port in {path=}')
+
+    return int(match[1])
+
+
+def decode_pdin(pdin: str) -> tuple[int, int]:
+    """
+    Split the hex process data into `(distance, status)`.
+    The distance is the second and third hex digit, the status the fourth.
+    """
+    word = int(pdin[:4], 16)
+
+    return (word >> 4) & 0xFF, word & 0x0F
+
+
+def decode_response(response: dict) -> dict[int, PortReading]:
+    """
+    Decode a `/getdatamulti` response into a reading per port.
+    """
+    readings = {}
+
+    for path, value in response['data'].items():
+        port = port_of(path)
+        code = value['code']
+
+        if 200 <= code < 300:
+            distance, status = decode_pdin(value['data'])
+            readings[port] = PortReading(port, code, distance, status)
+        else:
+            readings[port] = PortReading(port, code, None)
+
+    return readings
+
+
+def decode_batch(responses: Iterable[dict]) -> np.ndarray:
+    """
+    Decode many responses at once into an array of `BATCH_DTYPE`, one row per port per response.
+    The hex process data of every row is decoded with one array operation.
+    """
+    ports, codes, pdins = [], [], []
+
+    for response in responses:
+        for path, value in response['data'].items():
+            ports.append(port_of(path))
+            codes.append(value['code'])
+            pdins.append(value.get('data', '0000')[:4].ljust(4, '0'))
+
+    result = np.empty(len(ports), dtype=BATCH_DTYPE)
+    if not ports:
+        return result
+
+    nibbles = _HEX_VALUES[np.frombuffer(''.join(pdins).encode(), dtype=np.uint8).reshape(-1, 4)]
+    words = (nibbles[:, 0] << 12) | (nibbles[:, 1] << 8) | (nibbles[:, 2] << 4) | nibbles[:, 3]
+
+    result['port'] = ports
+    result['code'] = codes
+    result['in_range'] = (result['code'] >= 200) & (result['code'] < 300)
+    result['distance'] = np.where(result['in_range'], (words >> 4) & 0xFF, 0)
+    result['status'] = np.where(result['in_range'], words & 0x0F, 0)
+
+    return result
@@ -1,16 +1,26 @@
 from __future__ import annotations
 
-import operator
-import time
-from threading import Thread, Barrier
-from typing import Callable, Optional
-
-from Gripper import *
+import asyncio
+import os
+from typing import Optional
+
+import http_client
+import metrics
+import tracing
+from calibration import load_optional
 from camera import Camera
 from conveyor import Conveyor
+from orchestrator import Cell, Station, Route
 from robot import Robot
+from scheduler import Scheduler
 from stack import Stack
-from util import Vec2, Vec3, Pose, Object, RobotPickUp, Status
+from util import Vec2, Vec3, Pose, Object, Direction
+
+metrics_port = int(os.environ.get('CELL_METRICS_PORT', 9100))
+"""Port of the Prometheus metrics at `http://localhost:<port>/metrics`, 0 to not serve them"""
+
+trace_file = os.environ.get('CELL_TRACE')
+"""Save a Chrome trace of the run to this file, see `tracing`"""
 
 # TODO: Needs more tuning
 camera1 = Camera(ip='10.1.1.8',
@@ -19,8 +29,11 @@ camera1 = Camera(ip='10.1.1.8',
                  invert=Vec2(1, -1),
                  camera_cut=(Vec2(0, 160), Vec2(540, 450)),
                  camera_threshold=25,
-                 objects=[Object.CUBE, Object.CYLINDER])
-"""Camera for robot 1"""
+                 objects=[Object.CUBE, Object.CYLINDER],
+                 max_age=0.5,
+                 calibration=load_optional('calibration_camera_8.json'),
+                 memo_size=64)
+"""Camera for robot 1, `offsets`, `offset_scale` and `invert` are only used until it is calibrated"""
 
 camera2 = Camera(ip='10.1.1.7',
                  offsets=Vec2(-520, -240),
@@ -28,8 +41,11 @@ camera2 = Camera(ip='10.1.1.7',
                  invert=Vec2(1, 1),
                  camera_cut=(Vec2(0, 50), Vec2(400, 450)),
                  camera_threshold=25,
-                 objects=[Object.CUBE, Object.CYLINDER])
-"""Camera for robot 2"""
+                 objects=[Object.CUBE, Object.CYLINDER],
+                 max_age=0.5,
+                 calibration=load_optional('calibration_camera_7.json'),
+                 memo_size=64)
+"""Camera for robot 2, `offsets`, `offset_scale` and `invert` are only used until it is calibrated"""
 
 rob1_cords = {
     'conveyor': Pose(0.015, 0.285, -0.032),
@@ -53,8 +69,6 @@ rob2_cords = {
     Object.CYLINDER: Object.CYLINDER
 }
 
-end_program = False
-
 rob1: Optional[Robot] = None
 rob2: Optional[Robot] = None
 
@@ -80,9 +94,6 @@ rob2_conveyor_stack = Stack(name='r2_CS',
                             height=1,
                             obj=Object.CUBE)
 
-barrier1 = Barrier(2)
-barrier2 = Barrier(2)
-
 # noinspection PyBroadException
 try:
     rob1 = Robot(host='10.1.1.6',
@@ -91,7 +102,8 @@ try:
                  cords=rob1_cords,
                  place_stack=rob1_place_stack,
                  conveyor_stack=rob1_conveyor_stack,
-                 use_rt=True)
+                 use_rt=True,
+                 use_gripper_daemon=True)
 
     rob2 = Robot(host='10.1.1.5',
                  name='rob2',
@@ -99,10 +111,11 @@ try:
                  cords=rob2_cords,
                  place_stack=rob2_place_stack,
                  conveyor_stack=rob2_conveyor_stack,
-                 use_rt=True)
+                 use_rt=True,
+                 use_gripper_daemon=True,
+                 gripper_port=50002)
 
     Conveyor.robot = rob2
-    Conveyor.lock = rob2.lock
 except:
     print('Error occurred with initializing robots. Exiting')
     if rob1:
@@ -111,316 +124,64 @@ except:
     if rob2:
         rob2.close()
 
-    end_program = True
     exit()
 
-object_Pick_Up = RobotPickUp.NONE
-"""Robot to pick up from conveyor"""
-
-object_move = RobotPickUp.NONE
-"""Robot to move object to conveyor"""
-
-run_pre_run = False
-"""If true both robots move away so the pre run function can be ran again"""
-
-counter = 0
-
-objects_found = {
-    'rob1': {
-        Object.CUBE: [],
-        Object.CYLINDER: []
-    },
-    'rob2': {
-        Object.CUBE: [],
-        Object.CYLINDER: []
-    }
-}
-
-
-def termination_condition():
-    return end_program or counter < 2
-
-
-# Pre robot move functions
-def pre_run():
-    global rob1, rob2, camera1, camera2, object_move, object_Pick_Up, objects_found
-
-    objects_found['rob1'][rob1.object_move] = camera1.get_object(rob1.object_move)
-    objects_found['rob1'][rob1.object_store] = camera1.get_object(rob1.object_store)
-
-    objects_found['rob2'][rob2.object_move] = camera2.get_object(rob2.object_move)
-    objects_found['rob2'][rob2.object_store] = camera2.get_object(rob2.object_store)
-
-    if not objects_found['rob1'][rob1.object_move] and not objects_found['rob2'][rob2.object_move]:
-        print(f'No objects to move')
-        object_move = RobotPickUp.NONE
-
-    elif objects_found['rob1'][rob1.object_move] and not objects_found['rob2'][rob2.object_move]:
-        object_move = RobotPickUp.R1
-    elif not objects_found['rob1'][rob1.object_move] and objects_found['rob2'][rob2.object_move]:
-        object_move = RobotPickUp.R2
-
-    elif not objects_found['rob1'][rob1.object_store] and not objects_found['rob1'][rob1.object_store]:
-        if len(objects_found['rob1'][rob1.object_move]) > len(objects_found['rob2'][rob2.object_move]):
-            object_move = RobotPickUp.R2
-        else:
-            object_move = RobotPickUp.R1
-    elif not objects_found['rob1'][rob1.object_store] and objects_found['rob1'][rob1.object_store]:
-        object_move = RobotPickUp.R2
-    elif objects_found['rob1'][rob1.object_store] and not objects_found['rob1'][rob1.object_store]:
-        object_move = RobotPickUp.R1
-
-    elif len(objects_found['rob1'][rob1.object_store]) < len(objects_found['rob2'][rob2.object_store]):
-        print(f'Rob 1 move object: {rob1.object_store.name} {len(objects_found["rob1"][rob1.object_store])}')
-        object_move = RobotPickUp.R1
-    elif len(objects_found['rob1'][rob1.object_store]) > len(objects_found['rob2'][rob2.object_store]):
-        print(f'Rob 2 move object: {rob2.object_store.name} {len(objects_found["rob2"][rob2.object_store])}')
-        object_move = RobotPickUp.R2
-    elif len(objects_found['rob1'][rob1.object_store]) == len(objects_found['rob2'][rob2.object_store]):
-        object_move = RobotPickUp.R1
-
-    else:
-        print('kake')
-
-    print(f'Robot to move over its objects are {object_move=}')
-
-
-# Robot move functions
-def move(rob: Robot, camera: Camera, pre_run_func: Callable[[], None]):
-    global object_Pick_Up, object_move, rob1, rob2, barrier1, barrier2, run_pre_run
-
-    idle_count = 0
-
-    # Wait for both robots to reach idle state before beginning
-    rob.move(rob.cords['idlePose'])
-    rob.send_program(rq_open())
-
-    barrier1.wait()
-
-    while termination_condition():
-        if run_pre_run:
-            rob.log('Moving to pre run')
-
-            rob.move(rob.cords['idlePose'])
-            barrier1.wait()
-
-            if rob.name == 'rob2':
-                pre_run_func()
-
-            run_pre_run = False
-
-            barrier2.wait()
-
-        # Make robot move object to conveyor
-        if object_move.value == rob.name \
-                and Conveyor.status == Status.READY:
-            rob.log(f'Moving {rob.object_move.name} to other robot')
-
-            added_offset = Vec3(0.0, 0.0, 0.0) if rob.object_move == Object.CUBE else Vec3(0.04, -0.00, 0.0)
-
-            rob1.conveyor_stack.object = rob.object_move
-            rob2.conveyor_stack.object = rob.object_move
-
-            Conveyor.status = Status.WAIT
-
-            i = 0
-            while obj := camera.get_object(rob.object_move):
-                if i >= 4:
-                    break
-
-                rob.move_object_to_conveyor(obj[0].to_vec3() + added_offset, rob.object_move)
-                Conveyor.number_of_items_on_belt += 1
-
-                rob.move(rob.cords['idlePose'])
-
-                if rob.name == 'rob1':
-                    rob2.conveyor_stack.next()
-                else:
-                    rob1.conveyor_stack.next()
-
-                i += 1
-
-            Conveyor.status = Status.READY
-            object_move = RobotPickUp.NONE
-            object_Pick_Up = RobotPickUp.flip(rob.name)
-
-            rob.log(f'{object_Pick_Up=}')
-
-            rob.move(rob.cords['idlePose'])
-            pass
-
-        # Pick object form conveyor
-        elif object_Pick_Up.value == rob.name:
-            if Conveyor.status == Status.MOVING:
-                # Move to prepare for pickup
-                rob.move(rob.cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.1))
-            elif Conveyor.status == Status.NOT_READY:
-                # Start to pick object from conveyor
-                rob.log(f'Sorting {rob.object_store.name} from conveyor')
-
-                for i in range(0, Conveyor.number_of_items_on_belt):
-                    rob.log(f'{i}')
-                    rob.log(f'{rob.conveyor_stack=}')
-
-                    rob.place_stack.next()
-                    rob.place_stack.prev()
-
-                    rob.move_object_from_conveyor(rob.object_store)
-                    rob.move(rob.cords['idlePose'])
+stations = [Station(rob1, camera1), Station(rob2, camera2)]
 
-                rob1.conveyor_stack.reset()
-                rob2.conveyor_stack.reset()
+scheduler = Scheduler(stations, max_transfer=Cell.max_transfer)
+"""Chooses the robot to load the conveyor by the predicted makespan"""
 
-                Conveyor.number_of_items_on_belt = 0
-
-                object_Pick_Up = RobotPickUp.NONE
-                rob.status = Status.READY  # TODO: Is this needed?
-                Conveyor.status = Status.READY
-
-                run_pre_run = True
-            else:
-                rob.log(f'{Conveyor.status=}')
-                time.sleep(10)
-
-        # The other robot is still moving its objects to the conveyor, so sort its own
-        elif object_Pick_Up == RobotPickUp.NONE and object_move.value != rob.name \
-                and not run_pre_run:
-            sort_own_blocks(rob, camera)
-
-        # Found move object, run pre_run
-        elif object_Pick_Up == RobotPickUp.NONE and object_move == RobotPickUp.NONE and \
-                (camera.get_object(rob.object_move)):
-            rob.log(f'Found object ({rob.object_move.value}) that needs to be moved to the other robot.')
-            run_pre_run = True
-
-        # There are no robot set to move an object to the other robot
-        else:
-            if object_move == RobotPickUp.NONE and object_Pick_Up == RobotPickUp.NONE \
-                    and rob1.status == Status.READY and rob2.status == Status.READY:
-                # None of the robots are scheduled to do anything
-
-                time.sleep(5)
-            else:
-                sort_own_blocks(rob, camera)
-
-
-def sort_own_blocks(rob: Robot, camera: Camera):
-    if obj_store := camera.get_object(rob.object_store):
-        rob.log(f'Sorting {rob.object_store.name} at {obj_store[0]=}')
-
-        added_offset = Vec3(0.0, 0.0, 0.0) if rob.object_move == Object.CUBE else Vec3(0.0, 0.0, 0.02)
-
-        rob.pick_object(obj_store[0].to_pose(), rob.object_store)
-
-        place_pos = rob.place_stack.next()  # + added_offset
-
-        rob.place_object(place_pos.to_pose(), rob.object_store, end_over_object=False)
-
-        place_pos.z += rob.object_store['size'].z
-
-        rob.move(place_pos)
-
-        rob.move(rob.cords['idlePose'])
-
-
-# Main conveyor move code
-def conveyor_move():
-    global object_Pick_Up, object_move, end_program
-
-    while termination_condition():
-        # object_Pick_Up = RobotPickUp.NONE
-
-        dist_1 = Conveyor.get_distance(1)
-        dist_4 = Conveyor.get_distance(4)
-
-        if dist_4 < Conveyor.dist_to_wall and Conveyor.status == Status.READY:
-            Conveyor.status = Status.MOVING
-
-            Conveyor.set_speed(Conveyor.main_speed)\
-                .start_right()\
-                .block_for_detect_object(2)
-
-            time.sleep(Conveyor.wait_after_detect_right)
-
-            Conveyor.set_speed(Conveyor.stop_speed)\
-                .block_for_detect_object(1)\
-                .stop()
-
-            Conveyor.status = Status.NOT_READY
-
-            # Wait for object to be picked up
-            Conveyor.block_for_detect_object(1, operator.lt)
-
-            object_move = RobotPickUp.R2
-            Conveyor.status = Status.READY
-        elif dist_1 < Conveyor.dist_to_wall and Conveyor.status == Status.READY:
-            Conveyor.status = Status.MOVING
-
-            Conveyor.set_speed(Conveyor.main_speed)\
-                .start_left()\
-                .block_for_detect_object(3)
-
-            time.sleep(Conveyor.wait_after_detect_left)
-
-            Conveyor.set_speed(Conveyor.stop_speed)\
-                .block_for_detect_object(4)\
-                .stop()
-
-            Conveyor.status = Status.NOT_READY
-
-            # Wait for object to be picked up
-            Conveyor.block_for_detect_object(4, operator.lt)
-
-            object_move = RobotPickUp.R1
-            Conveyor.status = Status.READY
-
-
-# Other functions
-def main(
-        move_func: Callable[[Robot, Camera], None] = None,
-        robots: list[tuple[Robot, Camera]] = None,
-        conveyor_func: Callable[[], None] = None,
-        pre_run_func: Callable[[], None] = None):
-    if pre_run_func:
-        pre_run_func()
-
-    threads: list[Thread] = list()
-
-    if move_func and robots:
-        for rob in robots:
-            threads.append(Thread(target=move_func, args=(rob[0], rob[1], pre_run_func)))
-
-    if conveyor_func:
-        threads.append(Thread(target=conveyor_func))
-
-    for thread in threads:
-        thread.start()
-
-    for thread in threads:
-        thread.join()
+cell = Cell(
+    stations=stations,
+    conveyor=Conveyor,
+    routes=[
+        Route(source='rob1', target='rob2', start_sensor=4, pass_sensor=2, stop_sensor=1, direction=Direction.RIGHT,
+              wait_after_detect=Conveyor.wait_after_detect_right),
+        Route(source='rob2', target='rob1', start_sensor=1, pass_sensor=3, stop_sensor=4, direction=Direction.LEFT,
+              wait_after_detect=Conveyor.wait_after_detect_left),
+    ],
+    planner=scheduler.plan,
+    scheduler=scheduler
+)
 
 
 if __name__ == '__main__':
     print('Program start')
 
-    rob2.set_digital_out(7, 0)  # Make sure the conveyor stop is low before starting.
+    if trace_file:
+        tracing.start()
 
-    rob1.move(rob1.cords['idlePose'])
-    rob2.move(rob2.cords['idlePose'])
+    if metrics_port:
+        metrics.serve(metrics_port)
 
-    # Wait for both robots to reach idle state before beginning
-    while rob1.status == Status.MOVING and rob2.status == Status.MOVING:
-        pass
+    rob2.set_digital_out(7, 0)  # Make sure the conveyor stop is low before starting.
+    Conveyor.start_sensors()
+    camera1.start_capture()
+    camera2.start_capture()
 
     try:
-        # main(test_move, [(rob1, camera1), (rob2, camera2)], conveyor_move, pre_run1)
-        # main(move_above_objects, [(rob1, camera1), (rob2, camera2)])
-        main(move, [(rob1, camera1), (rob2, camera2)], conveyor_move, pre_run)
-        # main(conveyor_func=conveyor_move)
+        asyncio.run(cell.run())
     except KeyboardInterrupt:
+        pass
+    finally:
+        print('Program stopped')
         Conveyor.stop()
+        Conveyor.stop_sensors()
+        camera1.stop_capture()
+        camera2.stop_capture()
 
-    print('Program stopped')
-    Conveyor.stop()
-    rob1.close()
-    rob2.close()
+        for rob in (rob1, rob2):
+            rob.log(f'Phase timings:\n{rob.timings.report(cycle_phase="gripper_close")}')
+
+        for camera in (camera1, camera2):
+            print(f'Camera {camera.ip}: {camera.memo}')
+
+        for client in http_client.clients.values():
+            print(client.report())
+
+        if trace_file:
+            tracing.save(trace_file)
+            print(f'Trace saved to {trace_file}')
+
+        rob1.close()
+        rob2.close()
@@ -0,0 +1,221 @@
+"""
+Counters, gauges and histograms of the cell, served in the Prometheus text format.
+
+    import metrics
+
+    sorted_objects = metrics.counter('cell_objects_sorted_total', 'Objects placed on their stack', ['robot'])
+    sorted_objects.inc(robot='rob1')
+
+    metrics.serve(9100)     # http://localhost:9100/metrics
+
+Updating a metric takes a dict lookup under a lock, about a microsecond. Everything else happens when the metrics
+are scraped.
+"""
+from __future__ import annotations
+
+import bisect
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Any, Callable, Iterable, Optional
+
+
+class MetricsException(Exception):
+    pass
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra='') -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        labels.append(extra)
+
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: dict[tuple, Any] = {}
+        self.lock = Lock()
+
+    def key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise MetricsException(f'{self.name} has the labels {self.labels}, got {tuple(labels)}')
+
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f'{self.name}{format_labels(self.labels, key)} {format_value(value)}'
+                    for key, value in self.values.items()]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1.0, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Optional[Iterable[float]] = None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets or self.default_buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts = self.values.get(key)
+
+            if counts is None:
+                # Count per bucket, then the sum of the values
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0]
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+
+        for key, counts in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}')
+
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(counts[-1])}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {cumulative}')
+
+        return lines
+
+
+class Registry:
+    """
+    Named metrics, rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable[[], None]] = []
+        """Called before the metrics are rendered, e.g. to bring a metric of how long something lasts up to date"""
+        self.lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add `metric`, or return the one with the same name that is already registered.
+        """
+        with self.lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+
+        if type(existing) is not type(metric) or existing.labels != metric.labels:
+            raise MetricsException(f'{metric.name} is already registered as a different metric')
+
+        return existing
+
+    def render(self) -> str:
+        for collect in list(self.collectors):
+            collect()
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+"""The registry the module functions add metrics to"""
+
+
+def counter(name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+    return registry.register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+    return registry.register(Gauge(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: Iterable[str] = (),
+              buckets: Optional[Iterable[float]] = None) -> Histogram:
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line in the log of the cell
+        pass
+
+
+def serve(port=9100, host='127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serve `registry` at `http://host:port/metrics` from a background thread. Stop it with `shutdown()`.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    return server
@@ -0,0 +1,474 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import math
+from dataclasses import dataclass, replace
+from typing import Callable, Optional, TYPE_CHECKING
+
+import metrics
+import paths
+import pick_order
+import tracing
+from util import Vec2, Vec3, Pose, Object, Status, Direction
+
+if TYPE_CHECKING:
+    from camera import Camera
+    from robot import Robot
+    from scheduler import Scheduler
+
+
+objects_sorted = metrics.counter('cell_objects_sorted_total', 'Objects placed on the stack of their robot',
+                                 ['robot', 'source'])
+transfers = metrics.counter('cell_transfers_total', 'Conveyor transfers between robots', ['source', 'target'])
+transfer_seconds = metrics.histogram('cell_transfer_seconds', 'Time the conveyor took to move objects to the target',
+                                     buckets=(5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 120.0))
+plans = metrics.counter('cell_plans_total', 'Planner decisions, by the robot chosen to load the conveyor', ['loader'])
+
+
+@dataclass
+class Station:
+    """
+    A robot and the camera looking at its table.
+    """
+    robot: Robot
+    camera: Camera
+    motion: Optional[asyncio.Future] = None
+    """Motion started in the background, the next robot operation waits for it"""
+
+    def __post_init__(self):
+        # The camera's cached frames are stale once the robot has moved an object
+        self.robot.on_object_moved.append(self.camera.invalidate)
+
+
+@dataclass
+class Route:
+    """
+    How the conveyor moves objects from the `source` robot to the `target` robot.
+    """
+    source: str
+    target: str
+    start_sensor: int
+    """Sensor that sees the objects before they are moved"""
+    pass_sensor: int
+    """Sensor after which the conveyor slows down"""
+    stop_sensor: int
+    """Sensor where the conveyor stops"""
+    direction: Direction
+    wait_after_detect: float
+    """Time to keep the main speed after `pass_sensor` detected the object"""
+
+
+@dataclass
+class Transfer:
+    """
+    Objects a robot loaded onto the conveyor for the `receiver`.
+    """
+    route: Route
+    receiver: Station
+    count: int
+
+
+class Cell:
+    """
+    Event driven controller for the cell, replaces the robot and conveyor threads.
+
+    Every robot and the conveyor is a coroutine that sleeps until the cell state changes, blocking robot, camera
+    and conveyor calls run in worker threads. Any number of stations can be used, objects are moved between two
+    stations when there is a `Route` for them.
+    """
+    max_transfer = 4
+    """Most objects moved to the conveyor in one transfer"""
+    sort_batch = 4
+    """Most own objects sorted after one look at the table"""
+    rescan_interval = 0.5
+    """How often a robot with nothing to do looks at its table again"""
+
+    def __init__(self, stations: list[Station], conveyor, routes: list[Route],
+                 planner: Callable[[], Optional[Robot]], scheduler: Optional[Scheduler] = None):
+        """
+        `planner` returns the robot that should move its objects to the conveyor, or `None`.
+        It is called with every robot parked at idle. A `scheduler` also decides whether a loader loads its next
+        transfer while the receiver unloads the last one and whether the receiver sorts its own objects while the
+        conveyor moves, the cell tells it how long every transfer took.
+        """
+        self.stations = stations
+        self.conveyor = conveyor
+        self.routes = {(route.source, route.target): route for route in routes}
+        self.planner = planner
+        self.scheduler = scheduler
+
+        self.running = False
+        self.loader: Optional[Station] = None
+        """Station to move objects to the conveyor"""
+        self.receiver: Optional[Station] = None
+        """Station to pick up objects from the conveyor"""
+        self.route: Optional[Route] = None
+        self.loaded: Optional[Transfer] = None
+        """Objects at the start of the conveyor, they are moved once the receiver of the last transfer is done"""
+        self.conveyor_status = Status.READY
+        self.transfer_started = 0.0
+        self.items_on_belt = 0
+        self.replan = False
+        """If true every robot moves to idle so the planner can run again"""
+        self.parked: set[str] = set()
+        self.nothing_planned_at = -math.inf
+        """When the planner last chose no robot, it is not asked again within `rescan_interval`"""
+
+        self._changed = asyncio.Event()
+
+    @staticmethod
+    async def call(func, *args):
+        """
+        Await `func` if it is a coroutine function, otherwise run the blocking call in a worker thread.
+        """
+        if inspect.iscoroutinefunction(func):
+            return await func(*args)
+
+        # Shows on the track of the task what the worker thread is doing for it
+        with tracing.span(f'{func.__qualname__} (thread)'):
+            return await asyncio.to_thread(func, *args)
+
+    def notify(self):
+        """
+        Wake every coroutine waiting for the cell state to change.
+        """
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, timeout: Optional[float] = None):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    @tracing.traced()
+    async def wait_for(self, predicate: Callable[[], bool]):
+        while not predicate() and self.running:
+            await self.wait_for_change()
+
+    async def settle(self, station: Station):
+        if station.motion:
+            motion, station.motion = station.motion, None
+            await motion
+
+    async def robot_call(self, station: Station, func, *args):
+        """
+        Run a robot operation once the background motion of the station is done.
+        """
+        await self.settle(station)
+        return await self.call(func, *args)
+
+    def robot_start(self, station: Station, waypoints: list[Vec2 | Vec3 | Pose]):
+        """
+        Start moving the robot through `waypoints` on its motion thread, the next `robot_call` for the station waits
+        for it.
+        """
+        station.motion = asyncio.wrap_future(station.robot.move_path_async(waypoints))
+
+    @property
+    def conveyor_unused(self) -> bool:
+        """
+        No robot loads the conveyor and there are no objects on it.
+        """
+        return self.loader is None and self.loaded is None and self.receiver is None
+
+    def station_storing(self, obj: Object) -> Optional[Station]:
+        return next((station for station in self.stations if station.robot.object_store == obj), None)
+
+    async def run(self):
+        self.running = True
+
+        # Named tasks, every task is a track in a trace
+        tasks = [asyncio.create_task(self.robot_worker(station), name=station.robot.name)
+                 for station in self.stations]
+        tasks.append(asyncio.create_task(self.conveyor_worker(), name='conveyor'))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.running = False
+
+            # gather leaves the other workers running when one fails
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if self.conveyor_status == Status.MOVING:
+                await self.call(self.conveyor.stop)
+
+    def stop(self):
+        self.running = False
+        self.notify()
+
+    @tracing.traced()
+    async def park(self, station: Station):
+        """
+        Wait at idle until every robot is parked, the last robot to arrive runs the planner.
+        """
+        self.parked.add(station.robot.name)
+        self.notify()
+
+        if len(self.parked) < len(self.stations):
+            await self.wait_for(lambda: station.robot.name not in self.parked)
+            return
+
+        loader = await self.call(self.planner)
+        self.loader = next((s for s in self.stations if s.robot is loader), None)
+        plans.inc(loader=loader.name if loader else 'none')
+
+        if loader is None:
+            self.nothing_planned_at = asyncio.get_running_loop().time()
+        print(f'Robot to move over its objects is {loader.name if loader else None}')
+
+        self.replan = False
+        self.parked.clear()
+        self.notify()
+
+    async def robot_worker(self, station: Station):
+        rob = station.robot
+
+        # Wait for every robot to reach idle before beginning
+        await self.robot_call(station, rob.move, rob.cords['idlePose'])
+        await self.robot_call(station, rob.gripper_open)
+        await self.park(station)
+
+        while self.running:
+            if self.replan:
+                rob.log('Moving to pre run')
+                await self.robot_call(station, rob.move, rob.cords['idlePose'])
+                await self.park(station)
+
+            # Make robot move object to conveyor, also while the receiver of its last transfer unloads
+            elif self.loader is station:
+                await self.load_conveyor(station)
+
+            # Pick object from conveyor
+            elif self.receiver is station:
+                if self.conveyor_status == Status.MOVING:
+                    if not await self.sort_during_transfer(station):
+                        # Move to prepare for pickup
+                        await self.robot_call(station, rob.move, paths.conveyor_approach(rob.cords))
+                        await self.wait_for(lambda: self.conveyor_status != Status.MOVING)
+                elif self.conveyor_status == Status.NOT_READY:
+                    await self.unload_conveyor(station)
+                else:
+                    await self.wait_for_change()
+
+            # Sort own objects while the other robots use the conveyor
+            elif not await self.sort_own(station, detection := await self.call(station.camera.detect)):
+                if self.conveyor_unused and detection[rob.object_move] and \
+                        asyncio.get_running_loop().time() - self.nothing_planned_at >= self.rescan_interval:
+                    rob.log(f'Found object ({rob.object_move.name}) that needs to be moved to the other robot.')
+                    self.replan = True
+                    self.notify()
+                else:
+                    await self.wait_for_change(self.rescan_interval)
+
+        await self.settle(station)
+
+    @tracing.traced()
+    async def load_conveyor(self, station: Station):
+        rob, camera = station.robot, station.camera
+        target = self.station_storing(rob.object_move)
+        route = self.routes.get((rob.name, target.robot.name)) if target else None
+
+        if route is None:
+            rob.log(f'No route to move {rob.object_move.name} to')
+            self.loader = None
+            return
+
+        rob.log(f'Moving {rob.object_move.name} to {target.robot.name}')
+
+        added_offset = Vec3(0.0, 0.0, 0.0) if rob.object_move == Object.CUBE else Vec3(0.04, -0.00, 0.0)
+
+        rob.conveyor_stack.object = rob.object_move
+        target.robot.conveyor_stack.object = rob.object_move
+
+        idle, over = rob.cords['idlePose'], rob.object_move['over']
+
+        loaded = 0
+        while loaded < self.max_transfer and (found := await self.call(camera.get_object, rob.object_move)):
+            # The way from the table to the conveyor leads around the robot base through idle, so every object is a
+            # round trip from idle and the closest one is the shortest
+            position = min(found, key=lambda position: pick_order.distance(idle, position.to_vec3() + over))
+            await self.robot_call(station, rob.move_object_to_conveyor, position.to_vec3() + added_offset,
+                                  rob.object_move)
+
+            # The next object is detected while the robot travels back to idle
+            self.robot_start(station, [idle])
+            loaded += 1
+
+        self.loader = None
+
+        if loaded:
+            self.loaded = Transfer(route, target, loaded)
+            rob.log(f'{target.robot.name} picks up {loaded} objects')
+
+        self.notify()
+
+    @tracing.traced()
+    async def unload_conveyor(self, station: Station):
+        rob = station.robot
+        rob.log(f'Sorting {rob.object_store.name} from conveyor')
+
+        for i in range(self.items_on_belt):
+            rob.log(f'{i}')
+            rob.log(f'{rob.conveyor_stack=}')
+
+            rob.place_stack.next()
+            rob.place_stack.prev()
+
+            await self.robot_call(station, rob.move_object_from_conveyor, rob.object_store)
+            objects_sorted.inc(robot=rob.name, source='conveyor')
+
+        rob.conveyor_stack.reset()
+
+        self.items_on_belt = 0
+        self.receiver = None
+        self.route = None
+        self.conveyor_status = Status.READY
+        # Plan again, unless the loader already loads the next transfer of the plan
+        self.replan = self.loader is None and self.loaded is None
+        self.notify()
+
+    @tracing.traced()
+    async def sort_during_transfer(self, station: Station) -> bool:
+        """
+        Sort one own object of the receiving robot while the conveyor moves, if the scheduler predicts that delays
+        nothing. Returns false if the robot should wait at the conveyor.
+        The receiver can be the robot driving the conveyor, its paths do not hold up the belt outputs, see
+        `Robot.set_digital_out`.
+        """
+        if self.scheduler is None:
+            return False
+
+        rob = station.robot
+        detection = await self.call(station.camera.detect)
+
+        if not detection[rob.object_store]:
+            return False
+
+        position = min(detection[rob.object_store], key=lambda position: self.scheduler.sort_time(rob, position))
+        elapsed = asyncio.get_running_loop().time() - self.transfer_started
+
+        if not self.scheduler.sorts_during_transfer(rob, position, elapsed):
+            return False
+
+        return await self.sort_own(station, replace(detection, objects={**detection.objects,
+                                                                        rob.object_store: [position]}))
+
+    @tracing.traced()
+    async def sort_own(self, station: Station, detection) -> bool:
+        """
+        Sort the robot's own objects found in `detection`, at most `sort_batch` of them in the order with the shortest
+        travel. Returns while the robot travels back to idle, so the next camera capture overlaps with that move.
+        Returns false if there was nothing to sort.
+        """
+        rob = station.robot
+        obj_store = detection[rob.object_store]
+
+        if not obj_store:
+            return False
+
+        idle = rob.cords['idlePose']
+        over = rob.object_store['over']
+        order = pick_order.plan(idle, [position.to_vec3() + over for position in obj_store],
+                                [slot + over for slot in rob.place_stack.upcoming(self.sort_batch)], idle,
+                                self.sort_batch)
+
+        # The robot goes straight from the stack to the next object
+        via = []
+
+        for index in order:
+            if via and (self.replan or self.receiver is station or self.loader is station):
+                break
+
+            rob.log(f'Sorting {rob.object_store.name} at {obj_store[index]=}')
+
+            pick_pos = obj_store[index].to_pose()
+            await self.robot_call(station, rob.pick_object, pick_pos, rob.object_store, False, via)
+
+            place_pos = rob.place_stack.next().to_pose()
+
+            await self.robot_call(station, rob.place_object, place_pos, rob.object_store, False,
+                                  [paths.over(rob.cords, pick_pos, rob.object_store)])
+            objects_sorted.inc(robot=rob.name, source='table')
+
+            via = [paths.above_stack(place_pos, rob.object_store)]
+
+        self.robot_start(station, [*via, idle])
+
+        return True
+
+    async def conveyor_worker(self):
+        conveyor = self.conveyor
+
+        while self.running:
+            await self.wait_for(lambda: self.loaded is not None and self.items_on_belt == 0)
+
+            if not self.running:
+                break
+
+            route = self.loaded.route
+
+            # Make sure the objects are at the start of the conveyor
+            await self.call(conveyor.block_for_detect_object, route.start_sensor)
+
+            transfer, self.loaded = self.loaded, None
+            source = next(station for station in self.stations if station.robot.name == route.source)
+
+            # The receiver picks the objects up from the last one loaded
+            transfer.receiver.robot.conveyor_stack.reset()
+            for _ in range(transfer.count):
+                transfer.receiver.robot.conveyor_stack.next()
+
+            self.route = route
+            self.receiver = transfer.receiver
+            self.items_on_belt = transfer.count
+            self.conveyor_status = Status.MOVING
+            self.notify()
+
+            self.transfer_started = asyncio.get_running_loop().time()
+            await self.transfer(route)
+            seconds = asyncio.get_running_loop().time() - self.transfer_started
+            transfer_seconds.observe(seconds)
+            transfers.inc(source=route.source, target=route.target)
+
+            if self.scheduler:
+                self.scheduler.measured_transfer(seconds)
+
+            source.robot.conveyor_stack.reset()
+            self.conveyor_status = Status.NOT_READY
+            self.notify()
+
+            # The start of the conveyor is empty again
+            if self.scheduler and await self.loads_ahead(source, transfer):
+                source.robot.log('Loading the next transfer while the receiver unloads')
+                self.loader = source
+                self.notify()
+
+    @tracing.traced()
+    async def loads_ahead(self, source: Station, transfer: Transfer) -> bool:
+        """
+        Ask the scheduler whether the `source` of the delivered `transfer` loads the next one while the receiver
+        unloads.
+        """
+        detections = {station.robot.name: (await self.call(station.camera.detect)).objects
+                      for station in self.stations}
+
+        return self.scheduler.loads_ahead(source.robot, transfer.receiver.robot, transfer.count, detections)
+
+    @tracing.traced()
+    async def transfer(self, route: Route):
+        conveyor = self.conveyor
+
+        await self.call(conveyor.set_speed, conveyor.main_speed)
+        await self.call(conveyor.start_right if route.direction == Direction.RIGHT else conveyor.start_left)
+        await self.call(conveyor.block_for_detect_object, route.pass_sensor)
+
+        await asyncio.sleep(route.wait_after_detect)
+
+        await self.call(conveyor.set_speed, conveyor.stop_speed)
+        await self.call(conveyor.block_for_detect_object, route.stop_sensor)
+        await self.call(conveyor.stop)
@@ -0,0 +1,117 @@
+"""
+Waypoints of the robot operations. `Robot`, the simulated robot in `sim.py` and the `Scheduler` estimates all take
+them from here.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+
+from util import Object, Pose, Vec2, Vec3
+
+
+@dataclass
+class Pick:
+    """
+    Move through `via` without stopping to `obj` at `location` and close the gripper on it.
+    """
+    location: Pose
+    obj: Object
+    via: list[Vec2 | Vec3 | Pose] = field(default_factory=list)
+
+    def path(self, cords: dict) -> list[Vec2 | Vec3 | Pose]:
+        return [*self.via, *grip(cords, self.location, self.obj)]
+
+
+@dataclass
+class Place:
+    """
+    Move through `via` without stopping to put `obj` down at `location` and open the gripper.
+    """
+    location: Pose
+    obj: Object
+    via: list[Vec2 | Vec3 | Pose] = field(default_factory=list)
+
+    def path(self, cords: dict) -> list[Vec2 | Vec3 | Pose]:
+        return [*self.via, *grip(cords, self.location, self.obj)]
+
+
+@dataclass
+class Move:
+    """
+    One blended move through `waypoints`.
+    """
+    waypoints: list[Vec2 | Vec3 | Pose]
+
+    def path(self, cords: dict) -> list[Vec2 | Vec3 | Pose]:
+        return self.waypoints
+
+
+Step = Pick | Place | Move
+"""One part of an operation, the real and the simulated robot run them the same way"""
+
+
+def over(cords: dict, location: Pose, obj: Object) -> Pose:
+    return location + cords[obj]['over']
+
+
+def grip(cords: dict, location: Pose, obj: Object) -> list[Pose]:
+    """
+    Straight down from above `obj` at `location` to where the gripper closes on it.
+    """
+    return [over(cords, location, obj), location + cords[obj]['at']]
+
+
+def above_stack(place: Pose, obj: Object) -> Pose:
+    """
+    Above the object just put on a stack, the robot leaves the stack through it.
+    """
+    return Pose(place.x, place.y, place.z + obj['size'].z)
+
+
+def conveyor_approach(cords: dict) -> Vec3:
+    """
+    Above the start of the conveyor, where the robot waits for a transfer.
+    """
+    return cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.1)
+
+
+def sort_object(cords: dict, pick: Pose, place: Pose, obj: Object) -> list[Step]:
+    """
+    Move one object of the robot from `pick` to the slot `place` of its stack and return to idle.
+    """
+    return [
+        Pick(pick, obj),
+        Place(place, obj, [over(cords, pick, obj)]),
+        Move([above_stack(place, obj), cords['idlePose']]),
+    ]
+
+
+def to_conveyor(cords: dict, pick: Pose, slot: Vec3 | Pose, obj: Object) -> list[Step]:
+    """
+    Move `obj` from `pick` to the conveyor slot `slot`, ending at `conveyor_approach`.
+    """
+    drop = slot.to_pose() + Vec3(0.0, 0.0, 0.012 if obj == Object.CYLINDER else 0.002)
+    entry = cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.15)
+
+    return [
+        Pick(pick, obj),
+        Place(drop, obj, [over(cords, pick, obj), cords['idlePose'], entry]),
+        Move([over(cords, drop, obj)]),
+        Move([conveyor_approach(cords)]),
+    ]
+
+
+def from_conveyor(cords: dict, slot: Vec3 | Pose, place: Pose, obj: Object) -> list[Step]:
+    """
+    Move `obj` from the conveyor slot `slot` to the slot `place` of the stack and return to idle, starting at
+    `conveyor_approach`.
+    """
+    pick = Pose(slot.x + (-0.04 if obj == Object.CYLINDER else 0.0), slot.y, slot.z)
+    approach = conveyor_approach(cords)
+    idle = cords['idlePose']
+
+    return [
+        Pick(pick, obj, [approach]),
+        Place(place, obj, [over(cords, pick, obj), approach, idle, idle + Vec3(0.0, -0.2, 0.0)]),
+        Move([above_stack(place, obj), idle]),
+    ]
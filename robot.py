@@ -1,22 +1,50 @@
 from __future__ import annotations
 
-import urx
 import time
+from contextlib import nullcontext
+
+import urx
 
-from Gripper import *
-from util import Status, Vec2, Vec3, Pose, Object
+import metrics
+import paths
+import tracing
+from Gripper import program
+from gripper_daemon import GripperDaemon, DaemonCommand
+from util import Status, Vec2, Vec3, Pose, Object, PhaseTimer, wait_until
 from stack import Stack
+from concurrent.futures import Future, ThreadPoolExecutor
 from threading import Lock
+from typing import Callable, Optional
+
+
+class RobotTimeoutException(Exception):
+    pass
+
+
+status_seconds = metrics.counter('robot_status_seconds_total', 'Time the robots spent in each status',
+                                 ['robot', 'status'])
+picks = metrics.counter('robot_picks_total', 'Picks by result: held, missed when the gripper closed on nothing, or '
+                        'unknown without the gripper daemon', ['robot', 'result'])
 
 
 class Robot(urx.Robot):
     a, v = 0.5, 0.8
+    move_timeout = 30.0
+    """Longest time a single move is allowed to take"""
+    gripper_timeout = 5.0
+    """Longest time a gripper command is allowed to take"""
+    activate_timeout = 10.0
+    """Longest time activating the gripper is allowed to take"""
+    program_start_timeout = 0.1
+    """How long to wait for a program to be reported as running, the controller reports state at 10 Hz"""
+    blend = 0.05
+    """Default blend radius in meters for the waypoints of a path"""
 
     def __init__(
             self, host: str, name: str, object_store: Object,
             cords: dict[str | Object, Pose | dict[str, Vec3] | dict[str, Vec3] | dict[str, Vec3]],
             place_stack: Stack, conveyor_stack: Stack,
-            use_rt=False, use_simulation=False):
+            use_rt=False, use_simulation=False, use_gripper_daemon=False, gripper_port=50001):
         super().__init__(host, use_rt, use_simulation)
         self.name = name
         self.object_store = object_store
@@ -25,64 +53,223 @@ class Robot(urx.Robot):
         self.place_stack = place_stack
         self.conveyor_stack = conveyor_stack
         self.lock = Lock()
+        self.timings = PhaseTimer()
+
+        self.motion_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{name}_motion')
+        self.motion: Optional[Future] = None
+        """Last motion started with `move_async` or `move_path_async`"""
+
+        self.on_object_moved: list[Callable[[], None]] = []
+        """Called after every place, e.g. to invalidate the camera looking at the table. The arm has left the table by
+        then, a capture right after a pick would show it."""
+
+        self.gripper: Optional[GripperDaemon] = None
+        """Gripper daemon, when set gripper commands and moves are sent through it instead of as programs"""
+
+        self._status = Status.NOT_READY
+        self._status_since = time.monotonic()
+        self._status_lock = Lock()
+        metrics.registry.collectors.append(self.count_status)
 
         self.status = Status.NOT_READY
 
+        # sets robot tcp, the distance from robot flange to gripper tips.
+        self.set_tcp((0, 0, 0.16, 0, 0, 0))
+        self.wait_for_program(self.gripper_timeout)
+
+        if use_gripper_daemon:
+            self.gripper = GripperDaemon(self, port=gripper_port)
+            self.gripper.install()
+
         # activates gripper. only needed once per power cycle
-        self.send_program(rq_activate())
-        time.sleep(2.5)
+        self.gripper_activate()
         # sets speed of gripper to max
-        self.send_program(rq_set_speed(250))
-        time.sleep(0.1)
+        self.gripper_set_speed(250)
         # sets force of gripper to a low value
-        self.send_program(rq_set_force(10))
-        time.sleep(0.1)
-        # sets robot tcp, the distance from robot flange to gripper tips.
-        self.set_tcp((0, 0, 0.16, 0, 0, 0))
+        self.gripper_set_force(10)
 
         self.status = Status.READY
 
     def log(self, message: str):
         print(f'{self.name}:', message)
 
-    def pick_object(self, location: Pose, current_object, end_over_object=True):
+    @property
+    def status(self) -> Status:
+        return self._status
+
+    @status.setter
+    def status(self, status: Status):
+        with self._status_lock:
+            self._count_status()
+            self._status = status
+
+    def count_status(self):
+        """
+        Add the time since the last status change to `status_seconds`.
+        """
+        with self._status_lock:
+            self._count_status()
+
+    def _count_status(self):
+        now = time.monotonic()
+        status_seconds.inc(now - self._status_since, robot=self.name, status=self._status.name)
+        self._status_since = now
+
+    def close(self):
+        if self.count_status in metrics.registry.collectors:
+            metrics.registry.collectors.remove(self.count_status)
+
+        self.motion_executor.shutdown()
+
+        if self.gripper:
+            self.gripper.close()
+
+        super().close()
+
+    def object_moved(self):
+        for callback in self.on_object_moved:
+            callback()
+
+    def wait_for_program(self, timeout: float):
+        """
+        Wait for the last program sent to finish, using the program running state reported by the controller.
+        Only for programs sent without waiting, after a blocking call the start wait would always run out.
+        """
+        # A short program can be done before the controller reports it as running
+        wait_until(self.is_program_running, self.program_start_timeout)
+
+        if not wait_until(lambda: not self.is_program_running(), timeout):
+            raise RobotTimeoutException(f'{self.name}: program still running after {timeout}s')
+
+    @tracing.traced()
+    def gripper_command(self, command: DaemonCommand, value=None, timeout: Optional[float] = None, wait=True,
+                        phase: Optional[str] = None, replaces=0.0) -> Optional[str]:
+        """
+        Run a gripper command. With `wait` blocks until the robot has executed it, through the gripper daemon if it
+        is installed, otherwise as its own program. Returns the reply from the gripper daemon, or `None` without it
+        or without `wait`.
+        The wait is recorded as `phase` in `timings`, it replaced a fixed sleep of `replaces` seconds after sending
+        the command.
+        """
+        timeout = timeout if timeout is not None else self.gripper_timeout
+        args = [] if value is None else [value]
+
+        with tracing.locked(self.lock, f'{self.name} lock'):
+            if self.gripper:
+                # Queued, the next command that waits reads the reply
+                self.gripper.command(command, *args, wait=False)
+
+                if not wait:
+                    return None
+
+                with self.timings.phase(phase, replaces) if phase else nullcontext():
+                    return self.gripper.wait(timeout)
+
+            self.send_program(program('rq_' + command.name.lower(), value))
+
+            # A program is stopped by the next one, so even a command that does not wait has to finish
+            with self.timings.phase(phase, replaces) if phase and wait else nullcontext():
+                self.wait_for_program(timeout)
+
+        return None
+
+    def gripper_activate(self):
+        self.gripper_command(DaemonCommand.ACTIVATE_AND_WAIT, timeout=self.activate_timeout, phase='activate',
+                             replaces=2.5)
+
+    def gripper_open(self, wait=True):
+        """
+        Open the gripper. With `wait` blocks until the gripper has stopped moving, otherwise returns once the
+        command has been sent and the gripper opens while the robot moves on.
+        """
+        if wait:
+            self.gripper_command(DaemonCommand.OPEN_AND_WAIT, phase='gripper_open', replaces=0.2)
+        else:
+            self.gripper_command(DaemonCommand.OPEN, wait=False)
+
+    def gripper_close(self, wait=True) -> Optional[bool]:
+        """
+        Close the gripper. With `wait` blocks until the gripper has stopped moving, and returns if it detected
+        an object. The object detection is only known with the gripper daemon, otherwise returns `None`.
+        """
+        if not wait:
+            self.gripper_command(DaemonCommand.CLOSE, wait=False)
+            return None
+
+        reply = self.gripper_command(DaemonCommand.CLOSE_AND_WAIT, phase='gripper_close', replaces=0.6)
+
+        return reply == '1' if reply is not None else None
+
+    def gripper_move(self, position: int):
+        self.gripper_command(DaemonCommand.MOVE, position)
+
+    def gripper_set_speed(self, speed: int):
+        self.gripper_command(DaemonCommand.SET_SPEED, speed)
+
+    def gripper_set_force(self, force: int):
+        self.gripper_command(DaemonCommand.SET_FORCE, force)
+
+    def set_digital_out(self, output, val):
+        """
+        Set a standard digital output with a secondary program. It runs beside the gripper daemon or a motion program
+        without stopping it and without waiting for queued moves.
         """
-        Pick up an object at a location.
+        self.send_program(f'sec set_out():\n  set_standard_digital_out({output}, {bool(val)})\nend\n')
+
+    def set_analog_out(self, output, val, domain: Optional[int] = None):
+        """
+        Set a standard analog output with a secondary program, like `set_digital_out`.
+        `domain` 0 sets the output to current, 1 to voltage, `None` leaves it unchanged.
+        """
+        lines = [] if domain is None else [f'set_analog_outputdomain({output}, {domain})']
+        lines.append(f'set_standard_analog_out({output}, {val})')
+        self.send_program('sec set_out():\n' + ''.join(f'  {line}\n' for line in lines) + 'end\n')
+
+    @tracing.traced()
+    def pick_object(self, location: Pose, current_object, end_over_object=True,
+                    via: list[Vec2 | Vec3 | Pose] = ()):
+        """
+        Pick up an object at a location, passing through the `via` waypoints without stopping.
         Default to `CUBE` object
         """
-        with self.lock:
-            self.send_program(rq_open())
+        # The gripper opens during the approach, closing waits for it
+        self.gripper_open(wait=False)
         # time.sleep(0.1)
 
         # if center_before_move:
         #    self.center_object(location, current_object)
 
         # self.log(f'Move ({current_object.name}) above {location=}')
-        self.move(location + self.cords[current_object]['over'])
-        self.move(location + self.cords[current_object]['at'])
+        self.move_path(paths.Pick(location, current_object, list(via)).path(self.cords))
+
+        holding = self.gripper_close()
+
+        if holding is False:
+            self.log(f'No {current_object.name} detected in the gripper at {location=}')
+
+        picks.inc(robot=self.name, result={True: 'held', False: 'missed', None: 'unknown'}[holding])
 
-        with self.lock:
-            self.send_program(rq_close())
-        time.sleep(0.6)
         if end_over_object:
-            self.move(location + self.cords[current_object]['over'])
+            self.move(paths.over(self.cords, location, current_object))
 
-    def place_object(self, location: Pose, current_object, end_over_object=True):
+    @tracing.traced()
+    def place_object(self, location: Pose, current_object, end_over_object=True,
+                     via: list[Vec2 | Vec3 | Pose] = ()):
         """
-        Place an object at a location.
+        Place an object at a location, passing through the `via` waypoints without stopping.
         Default to `CUBE` object
         """
         self.log(f'Place {current_object.name} at {location=} of {type(location)=}')
-        self.move(location + self.cords[current_object]['over'])
-        self.move(location + self.cords[current_object]['at'])
+        self.move_path(paths.Place(location, current_object, list(via)).path(self.cords))
+
+        self.gripper_open()
 
-        with self.lock:
-            self.send_program(rq_open())
-        time.sleep(0.2)
+        self.object_moved()
 
         if end_over_object:
-            self.move(location + self.cords[current_object]['over'])
+            self.move(paths.over(self.cords, location, current_object))
 
+    @tracing.traced()
     def move(self, location: Vec2 | Vec3 | Pose, move_wait=True):
         """
         Function for moving robot using moveJ.
@@ -96,16 +283,111 @@ class Robot(urx.Robot):
         elif type(location) == Vec3:
             location = location.to_pose()
 
-        with self.lock:
+        with tracing.locked(self.lock, f'{self.name} lock'), self.timings.phase('move'):
             # moves robot
-            self.movex("movej", location.to_tuple(), acc=self.a, vel=self.a, wait=move_wait, relative=False,
-                       threshold=None)
+            if self.gripper:
+                self.gripper.command(DaemonCommand.MOVEJ, *location.to_tuple(), self.a, self.a,
+                                     wait=move_wait, timeout=self.move_timeout)
+            else:
+                # With `wait` movex returns once the robot is at the target, there is no program left to wait for
+                self.movex("movej", location.to_tuple(), acc=self.a, vel=self.a, wait=move_wait, relative=False,
+                           threshold=None)
+
+        self.status = Status.READY
+
+    def move_async(self, location: Vec2 | Vec3 | Pose) -> Future:
+        """
+        Start `move` on the motion thread and return at once.
+        The future is done when the robot has stopped, in asyncio it can be awaited with `asyncio.wrap_future`.
+        Asynchronous motions run in the order they are started.
+        """
+        self.motion = self.motion_executor.submit(self.move, location)
+        return self.motion
+
+    def move_path_async(self, waypoints: list[Vec2 | Vec3 | Pose], blend: Optional[float | list[float]] = None,
+                        linear=False) -> Future:
+        """
+        Start `move_path` on the motion thread and return at once, see `move_async`.
+        """
+        self.motion = self.motion_executor.submit(self.move_path, waypoints, blend, linear)
+        return self.motion
+
+    def wait_for_motion(self, timeout: Optional[float] = None):
+        """
+        Wait for the last asynchronous motion to finish, raises the exception from it if it failed.
+        """
+        if self.motion:
+            self.motion.result(timeout)
+
+    @staticmethod
+    def blend_radii(poses: list[Pose], blend: float | list[float]) -> list[float]:
+        """
+        Blend radius for each pose. A radius is limited to half the distance to the neighbouring poses,
+        the controller stops the program if blend zones overlap. The last pose is always reached exactly.
+        """
+        if isinstance(blend, (list, tuple)):
+            if len(blend) != len(poses):
+                raise ValueError(f'{len(blend)} blend radii for {len(poses)} waypoints, give one per waypoint')
+
+            radii = list(blend)
+        else:
+            radii = [blend] * len(poses)
+
+        for i, pose in enumerate(poses):
+            if i == len(poses) - 1:
+                radii[i] = 0.0
+                continue
+
+            radii[i] = min(radii[i], pose.distance(poses[i + 1]) / 2)
+
+            if i > 0:
+                radii[i] = min(radii[i], pose.distance(poses[i - 1]) / 2)
 
-        if move_wait:
-            time.sleep(0.1)
+        return radii
+
+    @tracing.traced()
+    def move_path(self, waypoints: list[Vec2 | Vec3 | Pose], blend: Optional[float | list[float]] = None,
+                  linear=False, move_wait=True):
+        """
+        Move through all `waypoints` as one blended motion, the robot only stops at the last one.
+        `blend` is the blend radius in meters, either one for all waypoints or one per waypoint.
+        `lock` is held until the robot has stopped at the last waypoint, so anything else that takes it waits for
+        the whole path. The conveyor outputs do not take it.
+        """
+        if not waypoints:
+            return
+
+        poses = [waypoint.to_pose() for waypoint in waypoints]
+        radii = self.blend_radii(poses, self.blend if blend is None else blend)
+
+        self.status = Status.MOVING
+
+        with tracing.locked(self.lock, f'{self.name} lock'), self.timings.phase('path'):
+            if self.gripper:
+                command = DaemonCommand.MOVEL if linear else DaemonCommand.MOVEJ
+
+                for pose, radius in zip(poses, radii):
+                    self.gripper.command(command, *pose.to_tuple(), self.a, self.a, radius, wait=False)
+
+                if move_wait:
+                    self.gripper.wait(self.move_timeout)
+            else:
+                self.send_program(self.path_program(poses, radii, 'movel' if linear else 'movej'))
+
+                if move_wait:
+                    self.wait_for_program(self.move_timeout * len(poses))
 
         self.status = Status.READY
 
+    def path_program(self, poses: list[Pose], radii: list[float], command='movej') -> str:
+        moves = ''.join(
+            f'  {command}(p[{", ".join(f"{value:.6f}" for value in pose.to_tuple())}], '
+            f'a={self.a}, v={self.a}, r={radius:.4f})\n'
+            for pose, radius in zip(poses, radii)
+        )
+
+        return f'def path():\n{moves}end\n'
+
     def move_object(self, from_pos: Vec3 | Vec2, to_pos: Vec3 | Vec2,
                     current_object, stop_at_idle=True, wait_at_idle=False,
                     center_before_move=False):
@@ -116,59 +398,43 @@ class Robot(urx.Robot):
         # self.log(f'Move {current_object=} {from_pos=} {to_pos=}')
         self.pick_object(from_pos.to_pose(), current_object, center_before_move)
 
-        if stop_at_idle:
-            self.move(self.cords['idlePose'], wait_at_idle)
-            time.sleep(0.5)
+        via = []
+        if stop_at_idle and wait_at_idle:
+            self.move(self.cords['idlePose'])
+        elif stop_at_idle:
+            # Pass through idle without stopping
+            via.append(self.cords['idlePose'])
 
-        self.place_object(to_pos.to_pose(), current_object)
+        self.place_object(to_pos.to_pose(), current_object, via=via)
 
+    @tracing.traced()
     def move_object_to_conveyor(self, pick_pos: Vec3, current_object):
         """
         Moves object form `pickPos` to the `conveyor` position.
         """
         # self.log(f'Move {current_object=} from conveyor to {pick_pos=}')
-        added_offset = Vec3(0.0, 0.0, 0.002)
-        if current_object == Object.CYLINDER:
-            added_offset.z = 0.012
-
-        self.pick_object(pick_pos.to_pose(), current_object)
-
-        self.move(self.cords['idlePose'])
-        self.move(self.cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.15))
-
-        self.place_object(self.conveyor_stack.next().to_pose() + added_offset, current_object)
-
-        self.move(self.cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.1))
+        self.run(paths.to_conveyor(self.cords, pick_pos.to_pose(), self.conveyor_stack.next(), current_object))
 
+    @tracing.traced()
     def move_object_from_conveyor(self, current_object):
         """
         Move object from conveyor to table
         """
         # self.log(f'Move {current_object=} from conveyor to {self.place_stack.peak()=}')
-        obj = self.conveyor_stack.prev()
-
-        self.move(self.cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.1))
+        slot = self.conveyor_stack.prev()
 
-        x_offset = -0.04 if current_object == Object.CYLINDER else 0.0
-        obj = Pose(obj.x + x_offset, obj.y, obj.z)
-
-        self.pick_object(obj, current_object)
-
-        self.move(self.cords['conveyor'].to_vec3() + Vec3(0.0, 0.1, 0.1))
         self.cords['object']['place'].y += current_object['size'].y + 0.01
 
-        self.move(self.cords['idlePose'])
-        time.sleep(1)
-
-        self.move(self.cords['idlePose'] + Vec3(0.0, -0.2, 0.0))
+        self.run(paths.from_conveyor(self.cords, slot, self.place_stack.next().to_pose(), current_object))
 
-        place_pos = self.place_stack.next()
-        place_pos = Pose(place_pos.x, place_pos.y, place_pos.z)
-
-        self.place_object(place_pos, current_object, end_over_object=False)
-
-        place_pos.z += self.object_store['size'].z
-
-        self.move(place_pos)
-
-        self.move(self.cords['idlePose'])
+    def run(self, steps: list[paths.Step]):
+        """
+        Run the steps of an operation from `paths`.
+        """
+        for step in steps:
+            if isinstance(step, paths.Pick):
+                self.pick_object(step.location, step.obj, end_over_object=False, via=step.via)
+            elif isinstance(step, paths.Place):
+                self.place_object(step.location, step.obj, end_over_object=False, via=step.via)
+            else:
+                self.move_path(step.waypoints)
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import Optional, TYPE_CHECKING
+
+import paths
+from util import Vec2, Vec3, Pose, Object
+
+if TYPE_CHECKING:
+    from robot import Robot
+
+
+@dataclass
+class MotionModel:
+    """
+    Predicted duration of robot moves and gripper commands.
+
+    A move takes the time of a trapezoidal profile along the straight lines between its waypoints, a blended path
+    only stops at its end.
+    """
+    speed: float = 0.25
+    """Tool speed in m/s of a joint move at the `Robot` speed of 0.5 rad/s, about 0.5 m from the base"""
+    acceleration: float = 0.5
+    program_time: float = 0.05
+    """Time to send a move to the controller and start it"""
+    gripper_close_time: float = 0.6
+    gripper_open_time: float = 0.2
+
+    def motion_time(self, distance: float) -> float:
+        """
+        Duration of a trapezoidal motion profile that stands still at both ends.
+        """
+        if distance <= self.speed * self.speed / self.acceleration:
+            return 2 * math.sqrt(distance / self.acceleration)
+
+        return distance / self.speed + self.speed / self.acceleration
+
+    def path_time(self, points: list[Vec2 | Vec3 | Pose]) -> float:
+        """
+        Duration of one blended move through `points`, starting at the first one.
+        """
+        points = [point.to_pose().to_vec3() for point in points]
+        distance = sum(a.distance(b) for a, b in zip(points, points[1:]))
+
+        return self.program_time + self.motion_time(distance)
+
+    def steps_time(self, cords: dict, start: Vec2 | Vec3 | Pose, steps: list[paths.Step]) -> float:
+        """
+        Duration of the steps of an operation from `paths`, starting at `start`. The gripper opens without waiting
+        before a pick, so only closing it and the opening after a place take time.
+        """
+        duration = 0.0
+
+        for step in steps:
+            path = step.path(cords)
+            duration += self.path_time([start, *path])
+            start = path[-1]
+
+            if isinstance(step, paths.Pick):
+                duration += self.gripper_close_time
+            elif isinstance(step, paths.Place):
+                duration += self.gripper_open_time
+
+        return duration
+
+
+@dataclass
+class Batch:
+    """
+    Objects one robot moves to the conveyor in one transfer.
+    """
+    loader: Robot
+    target: Robot
+    load_time: float
+    """Time for the loader to move the objects to the conveyor"""
+    unload_time: float
+    """Time for the target to move the objects from the conveyor to its stack"""
+
+
+class Scheduler:
+    """
+    Chooses the robot that moves its objects to the conveyor by the shortest predicted makespan, the time until every
+    object on the tables is sorted. It also decides whether a loader loads its next transfer while the target unloads
+    the last one, and whether the robot receiving a transfer sorts its own objects while the conveyor moves.
+
+    The work of a robot is sorting its own objects, loading objects for other robots onto the conveyor, and unloading
+    the objects other robots sent. The order of the transfers is searched, for each order the robots sort their own
+    objects whenever they wait: the target of a transfer while the loader loads, the loader while the conveyor moves
+    and the target unloads. A loader can load again as soon as the conveyor moved its objects away, so a robot with
+    several transfers to make keeps the conveyor busy. Times are predicted with `model` from the detected positions
+    and the robot coordinates, the time of a transfer is measured by the cell.
+    """
+    transfer_time = 12.7
+    """Time the conveyor takes to move objects between the robots until the cell measured a transfer, the mean
+    `cell_transfer_seconds` of `python sim.py --hours 8 --rate 60 --seed 0`"""
+    transfer_weight = 0.2
+    """Weight of the last measured transfer in `transfer_time`"""
+    max_orders = 2000
+    """Most transfer orders searched one by one, e.g. 6 transfers of two robots each are 924 orders. Tables with more
+    transfers are ordered greedily."""
+
+    def __init__(self, stations: list, max_transfer=4, model: Optional[MotionModel] = None):
+        """
+        `stations` are the `Station`s of the cell, `max_transfer` is the most objects moved in one transfer, see
+        `Cell.max_transfer`.
+        """
+        self.stations = stations
+        self.robots = [station.robot for station in stations]
+        self.max_transfer = max_transfer
+        self.model = model or MotionModel()
+        self.transfer_time = type(self).transfer_time
+        self.makespan = 0.0
+        """Predicted makespan of the last plan"""
+        self.spare = 0.0
+        """Own objects the loader of the last plan has left to sort once the target unloaded, in s. The receiver may
+        reach the conveyor that late without delaying anything."""
+
+    def measured_transfer(self, seconds: float):
+        """
+        Update `transfer_time` with a transfer the cell measured.
+        """
+        self.transfer_time += self.transfer_weight * (seconds - self.transfer_time)
+
+    def target(self, robot) -> Optional[Robot]:
+        return next((other for other in self.robots if other.object_store == robot.object_move), None)
+
+    def sort_time(self, robot, position: Vec2) -> float:
+        """
+        Time to move an object of the robot at `position` to its stack and return to idle, like `Cell.sort_own`.
+        """
+        steps = paths.sort_object(robot.cords, position.to_pose(), robot.place_stack.coords.to_pose(),
+                                  robot.object_store)
+
+        return self.model.steps_time(robot.cords, robot.cords['idlePose'], steps)
+
+    def load_time(self, robot, position: Vec2) -> float:
+        """
+        Time to move an object at `position` to the conveyor and return to idle, like `Robot.move_object_to_conveyor`.
+        """
+        steps = paths.to_conveyor(robot.cords, position.to_pose(), robot.cords['conveyor'], robot.object_move)
+
+        return (self.model.steps_time(robot.cords, robot.cords['idlePose'], steps)
+                + self.model.path_time([paths.conveyor_approach(robot.cords), robot.cords['idlePose']]))
+
+    def unload_time(self, robot) -> float:
+        """
+        Time to move an object from the conveyor to the stack, like `Robot.move_object_from_conveyor`.
+        """
+        steps = paths.from_conveyor(robot.cords, robot.cords['conveyor'], robot.place_stack.coords.to_pose(),
+                                    robot.object_store)
+
+        return self.model.steps_time(robot.cords, paths.conveyor_approach(robot.cords), steps)
+
+    def batches(self, robot, positions: list[Vec2]) -> list[Batch]:
+        """
+        The transfers needed to move the objects at `positions` to the robot storing them, the cell picks the
+        quickest ones first.
+        """
+        target = self.target(robot)
+        if target is None:
+            return []
+
+        positions = sorted(positions, key=lambda position: self.load_time(robot, position))
+
+        return [Batch(robot, target, sum(self.load_time(robot, position) for position in chunk),
+                      len(chunk) * self.unload_time(target))
+                for chunk in (positions[i:i + self.max_transfer] for i in range(0, len(positions), self.max_transfer))]
+
+    def approach_time(self, robot) -> float:
+        """
+        Time to move from idle to above the conveyor, where the robot waits for a transfer.
+        """
+        return self.model.path_time([robot.cords['idlePose'], paths.conveyor_approach(robot.cords)])
+
+    def makespan_of(self, order: list[Batch], backlog: dict[str, float],
+                    unloading: Optional[dict[str, float]] = None) -> float:
+        """
+        Predicted makespan of doing the transfers in `order`. `backlog` is the time every robot needs to sort its own
+        objects, a robot sorts them whenever it waits. `unloading` is the time robots still need to unload a transfer
+        the conveyor already delivered, by name.
+        """
+        backlog = dict(backlog)
+        unloading = unloading or {}
+        # When every robot is done with its last load or unload
+        free = {robot.name: unloading.get(robot.name, 0.0) for robot in self.robots}
+        # When the conveyor delivered the last transfer, and when its target had unloaded it
+        delivered = 0.0
+        unloaded = max(free.values(), default=0.0)
+
+        def work(robot, start: float, duration: float) -> float:
+            # The robot sorts its own objects until it starts, returns when it is done
+            name = robot.name
+            start = max(start, free[name])
+            backlog[name] = max(0.0, backlog[name] - (start - free[name]))
+            free[name] = start + duration
+
+            return free[name]
+
+        for batch in order:
+            # A loader loads as soon as its end of the conveyor is empty, the conveyor moves once the last transfer is
+            # unloaded
+            start = max(work(batch.loader, delivered, batch.load_time), unloaded)
+            delivered = start + self.transfer_time
+            unloaded = work(batch.target, start, self.transfer_time + batch.unload_time)
+
+        return max((free[name] + backlog[name] for name in free), default=0.0)
+
+    @staticmethod
+    def orders(queues: dict[str, list[Batch]]) -> int:
+        """
+        Number of orders of the batches that keep the order of every queue.
+        """
+        count = math.factorial(sum(len(queue) for queue in queues.values()))
+
+        for queue in queues.values():
+            count //= math.factorial(len(queue))
+
+        return count
+
+    def search(self, queues: dict[str, list[Batch]], backlog: dict[str, float], unloading: dict[str, float],
+               order: list[Batch]) -> tuple[float, list[Batch]]:
+        """
+        Order of the remaining batches with the shortest makespan. The batches of a robot keep their order.
+        """
+        if not any(queues.values()):
+            return self.makespan_of(order, backlog, unloading), order
+
+        best = (math.inf, [])
+
+        for name, queue in queues.items():
+            if queue:
+                candidate = self.search({**queues, name: queue[1:]}, backlog, unloading, order + [queue[0]])
+                best = min(best, candidate, key=lambda result: result[0])
+
+        return best
+
+    def greedy(self, queues: dict[str, list[Batch]], backlog: dict[str, float],
+               unloading: dict[str, float]) -> tuple[float, list[Batch]]:
+        """
+        Order of the batches that always takes the next batch with the shortest makespan of the order so far, for
+        too many batches to `search`.
+        """
+        order = []
+
+        while any(queues.values()):
+            name = min((name for name, queue in queues.items() if queue),
+                       key=lambda name: self.makespan_of(order + [queues[name][0]], backlog, unloading))
+            order.append(queues[name][0])
+            queues = {**queues, name: queues[name][1:]}
+
+        return self.makespan_of(order, backlog, unloading), order
+
+    def choose(self, detections: dict[str, dict[Object, Optional[list[Vec2]]]],
+               unloading: Optional[dict[str, float]] = None) -> Optional[Robot]:
+        """
+        Robot that should load the conveyor next, `None` if there is nothing to move between the robots.
+        `detections` are the objects found on the table of every robot, by robot name, `unloading` see `makespan_of`.
+        """
+        unloading = unloading or {}
+        backlog = {}
+        queues = {}
+
+        for robot in self.robots:
+            found = detections.get(robot.name, {})
+            backlog[robot.name] = sum(self.sort_time(robot, position)
+                                      for position in found.get(robot.object_store) or [])
+            queues[robot.name] = self.batches(robot, found.get(robot.object_move) or [])
+
+        if self.orders(queues) <= self.max_orders:
+            self.makespan, order = self.search(queues, backlog, unloading, [])
+        else:
+            self.makespan, order = self.greedy(queues, backlog, unloading)
+
+        self.spare = 0.0
+
+        if not order:
+            return None
+
+        first = order[0]
+        if len(order) == 1 or order[1].loader is not first.loader:
+            self.spare = max(0.0, backlog[first.loader.name] - self.transfer_time - first.unload_time)
+
+        return first.loader
+
+    def loads_ahead(self, loader: Robot, receiver: Robot, count: int,
+                    detections: dict[str, dict[Object, Optional[list[Vec2]]]]) -> bool:
+        """
+        Whether `loader` should load its next transfer while `receiver` unloads the `count` objects the conveyor just
+        delivered, rather than every robot waiting for the receiver to be done to plan again.
+        """
+        return self.choose(detections, {receiver.name: count * self.unload_time(receiver)}) is loader
+
+    def sorts_during_transfer(self, robot, position: Vec2, elapsed: float) -> bool:
+        """
+        Whether the robot receiving the transfer of the last plan should sort its object at `position`, `elapsed` s
+        after the conveyor started. It may reach the conveyor after the objects did as long as the loader still has
+        own objects to sort then, a sort that does not fit would leave the loader idle.
+        The robot may be the one driving the conveyor: the belt outputs are secondary programs under `Conveyor.lock`,
+        so stopping the belt never waits for the robot's path.
+        """
+        late = elapsed + self.sort_time(robot, position) + self.approach_time(robot) - self.transfer_time
+
+        return late <= self.spare
+
+    def plan(self) -> Optional[Robot]:
+        """
+        Look at every table and choose the robot to load the conveyor, the planner of the `Cell`.
+        """
+        return self.decide({station.robot.name: station.camera.detect([station.robot.object_move,
+                                                                       station.robot.object_store]).objects
+                            for station in self.stations})
+
+    def decide(self, detections: dict[str, dict[Object, Optional[list[Vec2]]]]) -> Optional[Robot]:
+        """
+        `choose` the robot to load the conveyor from `detections` and log the choice.
+        """
+        robot = self.choose(detections)
+        print(f'Scheduler: {robot.name if robot else None} loads the conveyor, '
+              f'predicted makespan {self.makespan:.1f} s')
+
+        return robot
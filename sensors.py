@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from threading import Condition, Thread
+from typing import Callable, Iterable, Optional
+
+
+@dataclass
+class SensorReading:
+    sensor: int
+    distance: float
+    timestamp: float
+    """`time.monotonic()` when the reading was received"""
+
+
+class SensorTimeoutException(Exception):
+    pass
+
+
+class SensorPoller:
+    """
+    Reads the conveyor sensors from a background thread and keeps the latest reading of each.
+
+    Every poll reads all `sensors` with one call to `read`. Subscribers are called with the new readings, and
+    threads can wait for a sensor to cross a threshold instead of polling the IO-Link master themselves.
+    """
+
+    def __init__(self, read: Callable[[Iterable[int]], dict[int, float]], sensors: Iterable[int] = (1, 2, 3, 4),
+                 rate=20.0):
+        """
+        `read` takes the sensors to read and returns the distance for each, `rate` is polls per second.
+        """
+        self.read = read
+        self.sensors = tuple(sensors)
+        self.rate = rate
+
+        self.latest: dict[int, SensorReading] = {}
+        self.errors = 0
+        self.subscribers: list[Callable[[dict[int, SensorReading]], None]] = []
+
+        self.condition = Condition()
+        self.running = False
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        if self.running:
+            return self
+
+        self.running = True
+        self.thread = Thread(target=self._run, name='sensor_poller', daemon=True)
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def subscribe(self, callback: Callable[[dict[int, SensorReading]], None]):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[dict[int, SensorReading]], None]):
+        self.subscribers.remove(callback)
+
+    def get_distance(self, sensor: int) -> Optional[float]:
+        """
+        Latest distance of the sensor, `None` before the first reading.
+        """
+        reading = self.latest.get(sensor)
+
+        return reading.distance if reading else None
+
+    def wait_for(self, sensor: int, predicate: Callable[[float], bool], timeout: Optional[float] = None) \
+            -> SensorReading:
+        """
+        Block until a reading of `sensor` taken after the call satisfies `predicate`.
+        """
+        start = time.monotonic()
+
+        def satisfied() -> bool:
+            reading = self.latest.get(sensor)
+            return reading is not None and reading.timestamp >= start and predicate(reading.distance)
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: satisfied() or not self.running, timeout):
+                raise SensorTimeoutException(f'Sensor {sensor} did not change within {timeout}s')
+
+            if not satisfied():
+                raise SensorTimeoutException('Sensor poller stopped')
+
+            return self.latest[sensor]
+
+    def _run(self):
+        period = 1 / self.rate
+
+        while self.running:
+            start = time.monotonic()
+
+            try:
+                distances = self.read(self.sensors)
+            except Exception as e:
+                self.errors += 1
+                print(f'Sensor poller: read failed ({e})')
+            else:
+                timestamp = time.monotonic()
+                readings = {sensor: SensorReading(sensor, distance, timestamp)
+                            for sensor, distance in distances.items()}
+
+                with self.condition:
+                    self.latest.update(readings)
+                    self.condition.notify_all()
+
+                for callback in self.subscribers:
+                    callback(readings)
+
+            time.sleep(max(0.0, period - (time.monotonic() - start)))
+
+        with self.condition:
+            self.condition.notify_all()
@@ -0,0 +1,637 @@
+"""
+Hardware-free simulation of the cell: simulated robots, cameras and conveyor driven by the `Cell` orchestration on a
+virtual clock, so a whole shift takes seconds.
+
+    python sim.py                       # an 8 hour shift
+    python sim.py --hours 1 --rate 30   # 30 objects per hour arrive on each table
+    python sim.py --verbose             # print the log of the cell
+    python sim.py --trace trace.json    # open in https://ui.perfetto.dev to see where the time goes
+
+Objects arrive at random times and places on both tables, the robots sort them with the same orchestration as
+`main.py`. Reports how many objects were sorted per hour and how long every robot was idle.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import math
+import operator
+import os
+import random
+import selectors
+import sys
+import time
+from copy import deepcopy
+from typing import Callable, Optional
+
+from camera import Detection
+from orchestrator import Cell, Station, Route
+from scheduler import MotionModel, Scheduler
+import paths
+import tracing
+from stack import Stack
+from util import Vec2, Vec3, Pose, Object, Direction
+
+
+class SimulationException(Exception):
+    pass
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """
+    Selector that never waits, it moves the clock of `loop` to the next timer instead.
+    """
+
+    def __init__(self, loop: VirtualClockLoop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout: Optional[float] = None):
+        events = super().select(0)
+
+        if not events:
+            if timeout is None:
+                raise SimulationException('Every task is waiting and no timer is scheduled, the cell is deadlocked')
+
+            self.loop.now += timeout
+
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop where time only passes when every task is waiting: `asyncio.sleep` and timeouts return at once, as if
+    the time had passed. Blocking calls in threads take no virtual time, everything simulated needs to be a coroutine.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        super().__init__(VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.now
+
+
+def now() -> float:
+    return asyncio.get_running_loop().time()
+
+
+class SimTable:
+    """
+    Objects lying on the table of one robot.
+    """
+    spacing = 0.08
+    """Smallest distance between the centers of objects that arrive"""
+    pick_tolerance = 0.045
+    """Furthest a pick can be from an object and still grab it, about half the stroke of the gripper"""
+
+    def __init__(self, name: str, center: Vec2, size: Vec2, capacity: int, rng: random.Random):
+        self.name = name
+        self.center = center
+        self.size = size
+        self.capacity = capacity
+        self.rng = rng
+
+        self.objects: list[tuple[Object, Vec2]] = []
+        self.arrived = 0
+        self.rejected = 0
+        """Objects that did not arrive because the table was full"""
+
+    def add_random(self) -> bool:
+        """
+        Put a random object at a free random place. Returns false if the table is full.
+        """
+        if len(self.objects) < self.capacity:
+            for _ in range(20):
+                position = Vec2(self.center.x + (self.rng.random() - 0.5) * self.size.x,
+                                self.center.y + (self.rng.random() - 0.5) * self.size.y)
+
+                if all(math.dist(position.to_tuple(), other.to_tuple()) >= self.spacing for _, other in self.objects):
+                    self.objects.append((self.rng.choice([Object.CUBE, Object.CYLINDER]), position))
+                    self.arrived += 1
+                    return True
+
+        self.rejected += 1
+        return False
+
+    def find(self, obj: Object) -> Optional[list[Vec2]]:
+        return [position.to_vec2() for kind, position in self.objects if kind == obj] or None
+
+    def take(self, location: Vec2 | Vec3 | Pose) -> Optional[Object]:
+        """
+        Remove the object closest to `location`, returns `None` if there is none within `pick_tolerance`.
+        """
+        target = location.to_pose().to_vec2().to_tuple()
+        candidates = [(math.dist(target, position.to_tuple()), i) for i, (_, position) in enumerate(self.objects)]
+        distance, index = min(candidates, default=(math.inf, None))
+
+        if distance > self.pick_tolerance:
+            return None
+
+        return self.objects.pop(index)[0]
+
+
+class SimConveyor:
+    """
+    Conveyor belt with the four distance sensors. Objects move with the belt, the belt speed is proportional to the
+    voltage set with `set_speed`. Positions along the belt are in meters from the end at sensor 1.
+    """
+    main_speed = 0.10
+    stop_speed = 0.025
+    wait_after_detect_left = 3
+    wait_after_detect_right = 3.3
+    dist_to_wall = 50
+
+    meters_per_volt = 0.8
+    """Belt speed in m/s per volt of the speed signal"""
+    length = 1.0
+    sensor_positions = {1: 0.05, 2: 0.35, 3: 0.65, 4: 0.95}
+    wall_distance = 120
+    """Distance in mm a sensor reads with nothing in front of it"""
+    object_distance = 30
+    """Distance in mm a sensor reads with an object in front of it"""
+    pulse_time = 0.1
+    """How long the start and stop outputs are held"""
+    poll_rate = 20.0
+    """Readings per second of the sensors, like `SensorPoller`"""
+    pitch = 0.07
+    """Distance between objects placed on the belt after each other"""
+    reach = 0.3
+    """Furthest from its end of the belt a robot can pick up an object"""
+
+    def __init__(self, ends: dict[str, float], verbose=False):
+        """
+        `ends` is the position on the belt where each robot places and picks objects.
+        """
+        self.ends = ends
+        self.verbose = verbose
+
+        self.items: list[list] = []
+        """`[object, position]` of every object on the belt"""
+        self.voltage = 0.0
+        self.move_direction = Direction.NONE
+        self.updated = 0.0
+        self.running_time = 0.0
+        self.runs = 0
+
+    def log(self, message):
+        if self.verbose:
+            print('Conveyor:', message)
+
+    def advance(self):
+        """
+        Move the objects to where they are now.
+        """
+        elapsed, self.updated = now() - self.updated, now()
+
+        if self.move_direction == Direction.NONE:
+            return
+
+        self.running_time += elapsed
+        step = self.voltage * self.meters_per_volt * elapsed * (-1 if self.move_direction == Direction.RIGHT else 1)
+
+        for item in self.items:
+            # Objects stop at the ends of the belt
+            item[1] = min(self.length, max(0.0, item[1] + step))
+
+    def load(self, end: str, obj: Object):
+        self.advance()
+        inward = 1 if self.ends[end] < self.length / 2 else -1
+        # Objects of the last transfer may still wait at the other end
+        placed = sum(abs(x - self.ends[end]) <= self.reach for _, x in self.items)
+        self.items.append([obj, self.ends[end] + inward * self.pitch * placed])
+
+    def take(self, end: str) -> Optional[Object]:
+        """
+        Remove the object closest to the `end` of a robot, returns `None` if no object is within reach.
+        """
+        self.advance()
+        item = min(self.items, key=lambda item: abs(item[1] - self.ends[end]), default=None)
+
+        if item is None or abs(item[1] - self.ends[end]) > self.reach:
+            return None
+
+        self.items.remove(item)
+        return item[0]
+
+    def get_distance(self, sensor: int) -> float:
+        self.advance()
+        position = self.sensor_positions[sensor]
+
+        if any(abs(position - x) < obj['size'].x / 2 for obj, x in self.items):
+            return self.object_distance
+
+        return self.wall_distance
+
+    @tracing.traced()
+    async def block_for_detect_object(self, sensor: int, compare=operator.gt, debug_print=False):
+        while compare(self.get_distance(sensor), self.dist_to_wall):
+            await asyncio.sleep(1 / self.poll_rate)
+
+        self.log(f'Sensor ({sensor}) detected block')
+
+        return self
+
+    async def set_speed(self, voltage: float):
+        self.advance()
+        self.voltage = voltage
+
+        return self
+
+    async def start(self, direction: Direction):
+        await asyncio.sleep(self.pulse_time)
+        self.advance()
+        self.move_direction = direction
+        self.runs += 1
+
+    async def start_right(self):
+        self.log('Started to move right')
+        await self.start(Direction.RIGHT)
+
+        return self
+
+    async def start_left(self):
+        self.log('Started to move left')
+        await self.start(Direction.LEFT)
+
+        return self
+
+    async def stop(self):
+        await asyncio.sleep(self.pulse_time)
+        self.advance()
+        self.move_direction = Direction.NONE
+
+        return self
+
+
+class SimCamera:
+    """
+    Camera that sees every object on a table.
+    """
+    capture_time = 0.12
+    """Time to get a frame and run the detectors"""
+
+    def __init__(self, table: SimTable, objects: list[Object]):
+        self.table = table
+        self.objects = objects
+        self.captures = 0
+        self.invalidations = 0
+
+    @tracing.traced()
+    async def detect(self, objects: Optional[list[Object]] = None, max_age: Optional[float] = None) -> Detection:
+        await asyncio.sleep(self.capture_time)
+        self.captures += 1
+
+        return Detection(now(), {obj: self.table.find(obj) for obj in objects or self.objects})
+
+    async def get_object(self, _object: Object) -> Optional[list[Vec2]]:
+        return (await self.detect([_object]))[_object]
+
+    def invalidate(self):
+        self.invalidations += 1
+
+
+class SimRobot:
+    """
+    Robot that takes the time the real one would for its moves and gripper commands.
+
+    The operations run the same `paths` steps as `Robot`, `model` gives the time they take.
+    """
+
+    stack_capacity = 8
+    """Objects on the place stack before an operator takes it away, 4 columns of 2"""
+
+    def __init__(self, name: str, object_store: Object, cords: dict, place_stack: Stack, conveyor_stack: Stack,
+                 table: SimTable, conveyor: SimConveyor, shift: float, model: MotionModel, verbose=False):
+        self.name = name
+        self.object_store = object_store
+        self.object_move = Object.flip(object_store)
+        self.cords = cords
+        self.place_stack = place_stack
+        self.conveyor_stack = conveyor_stack
+        self.table = table
+        self.conveyor = conveyor
+        self.shift = shift
+        self.model = model
+        self.verbose = verbose
+
+        self.on_object_moved: list[Callable[[], None]] = []
+        self.position: Vec3 = cords['idlePose'].to_vec3()
+        self.holding: Optional[Object] = None
+        self.motion: Optional[asyncio.Future] = None
+        """Last motion started with `move_path_async`"""
+
+        self.busy = 0.0
+        """Time spent moving and gripping during the shift"""
+        self.sorted = 0
+        self.missorted = 0
+        self.failed_picks = 0
+
+    def log(self, message: str):
+        if self.verbose:
+            print(f'{self.name}:', message)
+
+    def object_moved(self):
+        for callback in self.on_object_moved:
+            callback()
+
+    async def work(self, duration: float):
+        start = now()
+        self.busy += max(0.0, min(start + duration, self.shift) - min(start, self.shift))
+        await asyncio.sleep(duration)
+
+    async def move(self, location: Vec2 | Vec3 | Pose, move_wait=True):
+        await self.move_path([location])
+
+    @tracing.traced()
+    async def move_path(self, waypoints: list[Vec2 | Vec3 | Pose], blend: Optional[float | list[float]] = None,
+                        linear=False, move_wait=True):
+        if not waypoints:
+            return
+
+        duration = self.model.path_time([self.position, *waypoints])
+        self.position = waypoints[-1].to_pose().to_vec3()
+
+        await self.work(duration)
+
+    def move_path_async(self, waypoints: list[Vec2 | Vec3 | Pose], blend: Optional[float | list[float]] = None,
+                        linear=False) -> asyncio.Future:
+        """
+        Start `move_path` after the motions started before and return at once, like `Robot.move_path_async`.
+        """
+        previous = self.motion
+
+        async def run():
+            if previous:
+                await previous
+            await self.move_path(waypoints, blend, linear)
+
+        self.motion = asyncio.create_task(run(), name=f'{self.name} motion')
+        return self.motion
+
+    @tracing.traced()
+    async def gripper_open(self, wait=True):
+        # Without waiting the gripper opens while the robot moves on
+        if wait:
+            await self.work(self.model.gripper_open_time)
+
+    @tracing.traced()
+    async def gripper_close(self, wait=True) -> bool:
+        await self.work(self.model.gripper_close_time)
+
+        return self.holding is not None
+
+    async def grab(self, location: Pose, current_object, end_over_object: bool, via: list,
+                   take: Callable[[], Optional[Object]]):
+        await self.gripper_open(wait=False)
+        await self.move_path(paths.Pick(location, current_object, list(via)).path(self.cords))
+
+        self.holding = take()
+        if not await self.gripper_close():
+            self.failed_picks += 1
+            self.log(f'No {current_object.name} detected in the gripper at {location=}')
+
+        if end_over_object:
+            await self.move(paths.over(self.cords, location, current_object))
+
+    async def release(self, location: Pose, current_object, end_over_object: bool, via: list,
+                      put: Callable[[Object], None]):
+        await self.move_path(paths.Place(location, current_object, list(via)).path(self.cords))
+        await self.gripper_open()
+
+        if self.holding is not None:
+            put(self.holding)
+            self.holding = None
+
+        self.object_moved()
+
+        if end_over_object:
+            await self.move(paths.over(self.cords, location, current_object))
+
+    def store(self, obj: Object):
+        if obj == self.object_store:
+            self.sorted += 1
+        else:
+            self.missorted += 1
+
+        if len(self.place_stack.prev_positions) >= self.stack_capacity:
+            # An operator takes the full stack away
+            self.place_stack.reset()
+
+    @tracing.traced()
+    async def pick_object(self, location: Pose, current_object, end_over_object=True,
+                          via: list[Vec2 | Vec3 | Pose] = ()):
+        await self.grab(location, current_object, end_over_object, via, lambda: self.table.take(location))
+
+    @tracing.traced()
+    async def place_object(self, location: Pose, current_object, end_over_object=True,
+                           via: list[Vec2 | Vec3 | Pose] = ()):
+        await self.release(location, current_object, end_over_object, via, self.store)
+
+    @tracing.traced()
+    async def move_object_to_conveyor(self, pick_pos: Vec3, current_object):
+        await self.run(paths.to_conveyor(self.cords, pick_pos.to_pose(), self.conveyor_stack.next(), current_object),
+                       self.table.take, lambda obj: self.conveyor.load(self.name, obj))
+
+    @tracing.traced()
+    async def move_object_from_conveyor(self, current_object):
+        slot = self.conveyor_stack.prev()
+
+        await self.run(paths.from_conveyor(self.cords, slot, self.place_stack.next().to_pose(), current_object),
+                       lambda location: self.conveyor.take(self.name), self.store)
+
+    async def run(self, steps: list[paths.Step], take: Callable[[Pose], Optional[Object]],
+                  put: Callable[[Object], None]):
+        """
+        Run the steps of an operation from `paths` like `Robot.run`. A pick takes the object from `take`, a place
+        puts the held object on `put`.
+        """
+        for step in steps:
+            if isinstance(step, paths.Pick):
+                await self.grab(step.location, step.obj, False, step.via, lambda: take(step.location))
+            elif isinstance(step, paths.Place):
+                await self.release(step.location, step.obj, False, step.via, put)
+            else:
+                await self.move_path(step.waypoints)
+
+
+# Settings of the robots in `main.py`
+CORDS = {
+    'rob1': {
+        'conveyor': Pose(0.015, 0.285, -0.032),
+        'idlePose': Pose(0.25, -0.12, 0.09),
+        'object': {
+            'get': Vec3(0.00564, -0.32577, 0.0),
+            'place': Vec3(-0.293, -0.13, 0.0)
+        },
+        Object.CUBE: Object.CUBE,
+        Object.CYLINDER: Object.CYLINDER
+    },
+    'rob2': {
+        'conveyor': Pose(0.05, 0.276, -0.02),
+        'idlePose': Pose(-0.25, -0.12, 0.09),
+        'object': {
+            'get': Vec3(0.00773, -0.31881, 0.0),
+            'place': Vec3(0.27, -0.11, 0.002),
+        },
+        Object.CUBE: Object.CUBE,
+        Object.CYLINDER: Object.CYLINDER
+    },
+}
+
+
+class Simulation:
+    """
+    The two robot cell of `main.py` with simulated hardware.
+    """
+    table_size = Vec2(0.24, 0.12)
+    """Area around `cords['object']['get']` where objects arrive"""
+    table_capacity = 8
+    drain = 600.0
+    """Longest time after the end of the shift the cell may take to stop"""
+
+    def __init__(self, hours=8.0, rate=60.0, initial=4, seed=0, verbose=False):
+        """
+        `rate` is the mean number of objects per hour arriving at each table, `initial` the number on each table at
+        the start of the shift.
+        """
+        self.shift = hours * 3600
+        self.model = MotionModel()
+        self.rate = rate
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+
+        self.conveyor = SimConveyor({'rob1': SimConveyor.sensor_positions[4], 'rob2': SimConveyor.sensor_positions[1]},
+                                    verbose)
+        self.robots: list[SimRobot] = []
+        self.cameras: list[SimCamera] = []
+
+        for name, store in (('rob1', Object.CUBE), ('rob2', Object.CYLINDER)):
+            cords = deepcopy(CORDS[name])
+            table = SimTable(name, cords['object']['get'].to_vec2(), self.table_size, self.table_capacity, self.rng)
+
+            for _ in range(initial):
+                table.add_random()
+
+            place_stack = Stack(name=f'{name[0]}{name[-1]}_PS', coords=deepcopy(cords['object']['place']),
+                                direction=Vec2(0.0, -1.0), height=2, obj=store)
+            conveyor_stack = Stack(name=f'{name[0]}{name[-1]}_CS', coords=cords['conveyor'].to_vec3(),
+                                   direction=Vec2(0.0, 1.0), height=1, obj=Object.flip(store))
+
+            self.robots.append(SimRobot(name, store, cords, place_stack, conveyor_stack, table, self.conveyor,
+                                        self.shift, self.model, verbose))
+            self.cameras.append(SimCamera(table, [Object.CUBE, Object.CYLINDER]))
+
+        stations = [Station(robot, camera) for robot, camera in zip(self.robots, self.cameras)]
+        self.scheduler = Scheduler(stations, Cell.max_transfer, self.model)
+
+        self.cell = Cell(
+            stations=stations,
+            conveyor=self.conveyor,
+            routes=[
+                Route(source='rob1', target='rob2', start_sensor=4, pass_sensor=2, stop_sensor=1,
+                      direction=Direction.RIGHT, wait_after_detect=SimConveyor.wait_after_detect_right),
+                Route(source='rob2', target='rob1', start_sensor=1, pass_sensor=3, stop_sensor=4,
+                      direction=Direction.LEFT, wait_after_detect=SimConveyor.wait_after_detect_left),
+            ],
+            planner=self.plan,
+            scheduler=self.scheduler
+        )
+
+        self.sorted_at_end: dict[str, int] = {}
+        """Objects every robot had sorted when the shift ended, the cell may finish a move after it"""
+        self.running_at_end = 0.0
+        self.stopped = True
+
+    async def plan(self) -> Optional[SimRobot]:
+        """
+        `Scheduler.plan` of `main.py`, with the detections of the simulated cameras.
+        """
+        return self.scheduler.decide({robot.name: (await camera.detect([robot.object_move, robot.object_store])).objects
+                                      for robot, camera in zip(self.robots, self.cameras)})
+
+    async def arrivals(self, table: SimTable):
+        while now() < self.shift:
+            await asyncio.sleep(self.rng.expovariate(self.rate / 3600))
+            table.add_random()
+
+    def end_shift(self):
+        self.sorted_at_end = {robot.name: robot.sorted for robot in self.robots}
+        self.conveyor.advance()
+        self.running_at_end = self.conveyor.running_time
+        self.cell.stop()
+
+    async def run(self):
+        asyncio.get_running_loop().call_later(self.shift, self.end_shift)
+        feeders = [asyncio.ensure_future(self.arrivals(robot.table)) for robot in self.robots] if self.rate else []
+
+        try:
+            await asyncio.wait_for(self.cell.run(), self.shift + self.drain)
+        except asyncio.TimeoutError:
+            self.stopped = False
+        finally:
+            for feeder in feeders:
+                feeder.cancel()
+
+    def report(self) -> str:
+        hours = self.shift / 3600
+        total = sum(self.sorted_at_end.values())
+        lines = [f'Sorted {total} objects in {hours:g} h, {total / hours:.1f} per hour',
+                 f'Conveyor: {self.conveyor.runs} runs, moving {self.running_at_end / self.shift:.0%} of the time']
+
+        for robot in self.robots:
+            idle = self.shift - robot.busy
+            lines.append(f'{robot.name}: sorted {self.sorted_at_end[robot.name]} {robot.object_store.name}, '
+                         f'idle {idle / 3600:.2f} h ({idle / self.shift:.0%}), {robot.failed_picks} failed picks, '
+                         f'{robot.missorted} missorted')
+
+        for robot in self.robots:
+            table = robot.table
+            lines.append(f'{table.name} table: {table.arrived} arrived, {len(table.objects)} left, '
+                         f'{table.rejected} did not fit')
+
+        if not self.stopped:
+            lines.append(f'The cell did not stop within {self.drain:g} s after the end of the shift, it is stuck')
+
+        return '\n'.join(lines)
+
+
+def simulate(simulation: Simulation, trace_file: Optional[str] = None):
+    """
+    Run the shift, with `trace_file` save a trace of it in simulated time, see `tracing`.
+    """
+    loop = VirtualClockLoop()
+
+    if trace_file:
+        tracing.start(loop.time)
+
+    try:
+        loop.run_until_complete(simulation.run())
+
+        if trace_file:
+            tracing.stop()
+            tracing.save(trace_file)
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, default=8.0, help='length of the shift')
+    parser.add_argument('--rate', type=float, default=60.0, help='objects per hour arriving on each table')
+    parser.add_argument('--initial', type=int, default=4, help='objects on each table at the start')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='print the log of the cell')
+    parser.add_argument('--trace', help='save a Chrome trace of the shift to this file')
+    args = parser.parse_args()
+
+    sim = Simulation(args.hours, args.rate, args.initial, args.seed, args.verbose)
+    start = time.perf_counter()
+
+    # The cell prints every decision
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        simulate(sim, args.trace)
+
+    print(f'Simulated {args.hours:g} h in {time.perf_counter() - start:.1f} s')
+    print(sim.report())
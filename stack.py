@@ -40,6 +40,14 @@ class Stack:
 
         return return_value
 
+    def upcoming(self, count: int) -> list[Vec3]:
+        """
+        The next `count` positions `next` returns, without taking them.
+        """
+        stack = deepcopy(self)
+
+        return [stack.next() for _ in range(count)]
+
     def prev(self) -> Optional[Vec3]:
         """
         Return the previous added location. If the list is empty returns None
@@ -57,6 +65,7 @@ class Stack:
     def reset(self):
         self.coords = deepcopy(self.original_coords)
         self.prev_positions = []
+        self.current_height = 0
 
     def peak(self) -> Vec3:
         return self.prev_positions[-1]
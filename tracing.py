@@ -0,0 +1,212 @@
+"""
+Span tracing of the cell, saved as a Chrome trace that can be opened in https://ui.perfetto.dev or chrome://tracing.
+
+    import tracing
+
+    tracing.start()
+    ...
+    tracing.save('trace.json')
+
+Every thread and every asyncio task gets its own track. Nothing is recorded until `start` is called, until then
+`span` and `traced` cost one attribute lookup. `locked` always adds the time it waited to the `lock_wait_seconds`
+metric.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from enum import Enum
+from typing import Callable, Optional
+
+import metrics
+
+lock_wait_seconds = metrics.histogram('lock_wait_seconds', 'Time spent waiting for a lock, 0 when it was free',
+                                      ['lock'], buckets=(0.0, 0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+
+class Tracer:
+    """
+    Records spans as Chrome trace complete events.
+    """
+    max_events = 1_000_000
+    """Only the latest events are kept, a span is about 200 bytes"""
+
+    def __init__(self):
+        self.enabled = False
+        self.clock: Callable[[], float] = time.perf_counter
+        self.origin = 0.0
+        self.events: deque[dict] = deque(maxlen=self.max_events)
+        self.tracks: dict[int, str] = {}
+        self.task_tracks: dict[str, int] = {}
+        """Track of the tasks with each name, e.g. the motions of a robot are tasks that run after each other"""
+        self.lock = threading.Lock()
+
+    def start(self, clock: Callable[[], float] = time.perf_counter):
+        """
+        Start recording, `clock` returns the time in seconds, e.g. the time of a simulated event loop.
+        """
+        with self.lock:
+            self.clock = clock
+            self.origin = clock()
+            self.events.clear()
+            self.tracks.clear()
+            self.task_tracks.clear()
+            self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def track(self) -> int:
+        """
+        Id of the track of the current asyncio task, or of the current thread outside of tasks.
+        Tasks with the same name share a track.
+        """
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        if task is not None:
+            name = task.get_name()
+
+            if name not in self.task_tracks:
+                with self.lock:
+                    self.task_tracks.setdefault(name, len(self.task_tracks) + 1)
+
+            track = self.task_tracks[name]
+        else:
+            thread = threading.current_thread()
+            track, name = thread.ident, thread.name
+
+        if track not in self.tracks:
+            with self.lock:
+                self.tracks[track] = name
+
+        return track
+
+    def span(self, name: str, **args):
+        """
+        Context manager that records the time spent in it as a span called `name`, `args` are shown with it.
+        """
+        return self._span(name, args) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _span(self, name: str, args: dict):
+        track = self.track()
+        start = self.clock()
+
+        try:
+            yield
+        finally:
+            end = self.clock()
+            self.events.append({'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6,
+                                'dur': (end - start) * 1e6, 'pid': os.getpid(), 'tid': track, 'args': args})
+
+    def locked(self, lock, name: str):
+        """
+        Acquire `lock` as a context manager, the time spent waiting for it is recorded as `wait <name>`.
+        """
+        return self._locked(lock, name)
+
+    @contextmanager
+    def _locked(self, lock, name: str):
+        if lock.acquire(blocking=False):
+            lock_wait_seconds.observe(0.0, lock=name)
+        else:
+            start = time.perf_counter()
+
+            with self.span(f'wait {name}'):
+                lock.acquire()
+
+            lock_wait_seconds.observe(time.perf_counter() - start, lock=name)
+
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def save(self, path: str):
+        with self.lock:
+            tracks = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': track, 'args': {'name': name}}
+                      for track, name in self.tracks.items()]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': tracks + list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
+"""The tracer used by `span`, `traced` and `locked`"""
+
+
+def start(clock: Callable[[], float] = time.perf_counter):
+    tracer.start(clock)
+
+
+def stop():
+    tracer.stop()
+
+
+def save(path: str):
+    tracer.save(path)
+
+
+def span(name: str, **args):
+    return tracer.span(name, **args)
+
+
+def locked(lock, name: str):
+    return tracer.locked(lock, name)
+
+
+def call_args(args: tuple) -> dict:
+    """
+    The arguments of a call worth showing with its span: the name of the object of a method and simple values.
+    """
+    shown = {}
+
+    if args and isinstance(getattr(args[0], 'name', None), str):
+        shown['object'], args = args[0].name, args[1:]
+
+    values = [arg.name if isinstance(arg, Enum) else arg for arg in args if isinstance(arg, (int, float, str, Enum))]
+    if values:
+        shown['args'] = values
+
+    return shown
+
+
+def traced(name: Optional[str] = None):
+    """
+    Decorator that records every call of a function or coroutine function as a span, named after the function by
+    default. Methods of objects with a `name`, like robots, show it with the span.
+    """
+
+    def decorator(func):
+        label = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+
+                with tracer.span(label, **call_args(args)):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return func(*args, **kwargs)
+
+                with tracer.span(label, **call_args(args)):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
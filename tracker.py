@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Callable, Optional
+
+import cv2
+import numpy as np
+
+
+class ObjectTracker:
+    """
+    Keeps the bounding boxes of one kind of object on the table and only searches the parts of a frame that changed.
+
+    Every update compares the frame with the previous one. Known objects centered near a changed region are dropped
+    and the detector is run on the region plus a margin, objects found there replace them. Objects cut by the edge
+    of the searched part are ignored, the whole object is inside it when it is centered near the change. The whole
+    frame is searched at the first update, when most of the frame changed (e.g. the light), and every `refresh`
+    updates.
+    """
+    margin = 64
+    """Full resolution pixels around a changed region where objects are replaced, at least half an object"""
+    diff_threshold = 25
+    """Smallest change of a pixel between frames that counts, larger than the sensor noise"""
+    min_changed_pixels = 4
+    """Smaller changed areas are noise"""
+    max_changed = 0.25
+    """Fraction of the frame that may change before the whole frame is searched"""
+    refresh = 100
+
+    def __init__(self, find: Callable[[np.ndarray], np.ndarray], scale=1):
+        """
+        `find` returns the full resolution bounding boxes `(x0, y0, x1, y1)` of the objects in an image, relative to
+        its corner.
+        `scale` is how much smaller the images are than full resolution.
+        """
+        self.find = find
+        self.scale = scale
+        self.lock = Lock()
+
+        self.previous: Optional[np.ndarray] = None
+        self.boxes = np.empty((0, 4))
+        """Full resolution bounding boxes of the known objects"""
+
+        self.full_updates = 0
+        self.partial_updates = 0
+        self.unchanged_updates = 0
+        self.searched = 0.0
+        """Sum over all updates of the fraction of the frame that was searched"""
+
+    def reset(self):
+        with self.lock:
+            self.previous = None
+            self.boxes = np.empty((0, 4))
+
+    def update(self, img: np.ndarray) -> np.ndarray:
+        """
+        Bounding boxes of the objects in `img`, see `boxes`.
+        """
+        with self.lock:
+            return self._update(img)
+
+    def _update(self, img: np.ndarray) -> np.ndarray:
+        previous, self.previous = self.previous, img
+        updates = self.full_updates + self.partial_updates + self.unchanged_updates
+
+        if previous is None or previous.shape != img.shape or updates % self.refresh == 0:
+            return self._search_all(img)
+
+        changed = cv2.threshold(cv2.absdiff(img, previous), self.diff_threshold, 1, cv2.THRESH_BINARY)[1]
+        count = cv2.countNonZero(changed)
+
+        if count > self.max_changed * changed.size:
+            return self._search_all(img)
+
+        regions = self.regions(changed) if count >= self.min_changed_pixels else []
+
+        if not regions:
+            self.unchanged_updates += 1
+            return self.boxes
+
+        self.partial_updates += 1
+
+        height, width = img.shape[:2]
+        margin = -(-self.margin // self.scale)
+        inside = np.zeros(len(self.boxes), dtype=bool)
+        found = []
+
+        for x0, y0, x1, y1 in regions:
+            core = np.array([x0 - margin, y0 - margin, x1 + margin, y1 + margin]) * self.scale
+            roi = np.array([max(0, x0 - 2 * margin), max(0, y0 - 2 * margin),
+                            min(width, x1 + 2 * margin), min(height, y1 + 2 * margin)])
+
+            self.searched += (roi[2] - roi[0]) * (roi[3] - roi[1]) / (width * height)
+
+            boxes = self.find(img[roi[1]:roi[3], roi[0]:roi[2]]) + np.tile(roi[:2] * self.scale, 2)
+
+            # The edges of the frame do not cut objects
+            edges = np.where([roi[0] > 0, roi[1] > 0, roi[2] < width, roi[3] < height], roi * self.scale,
+                             [-np.inf, -np.inf, np.inf, np.inf])
+
+            keep = self.within(self.centers(boxes), core)
+            keep &= (boxes[:, :2] > edges[:2]).all(axis=1) & (boxes[:, 2:] < edges[2:]).all(axis=1)
+
+            # Objects centered in an earlier region have already been found there
+            for earlier, _ in found:
+                keep &= ~self.within(self.centers(boxes), earlier)
+
+            found.append((core, boxes[keep]))
+            inside |= self.within(self.centers(self.boxes), core)
+
+        self.boxes = np.concatenate([self.boxes[~inside]] + [boxes for _, boxes in found])
+
+        return self.boxes
+
+    def regions(self, changed: np.ndarray) -> list[tuple[int, int, int, int]]:
+        """
+        Bounding boxes `(x0, y0, x1, y1)` of the changed areas in the `changed` mask, in image pixels.
+        """
+        contours, _ = cv2.findContours(changed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        regions = []
+
+        for x, y, w, h in map(cv2.boundingRect, contours):
+            if cv2.countNonZero(changed[y:y + h, x:x + w]) >= self.min_changed_pixels:
+                regions.append((x, y, x + w, y + h))
+
+        return regions
+
+    @staticmethod
+    def centers(boxes: np.ndarray) -> np.ndarray:
+        return (boxes[:, :2] + boxes[:, 2:]) / 2
+
+    @staticmethod
+    def within(points: np.ndarray, box: np.ndarray) -> np.ndarray:
+        return (points >= box[:2]).all(axis=1) & (points < box[2:]).all(axis=1)
+
+    def _search_all(self, img: np.ndarray) -> np.ndarray:
+        self.full_updates += 1
+        self.searched += 1.0
+        self.boxes = self.find(img)
+
+        return self.boxes
+
+    def __repr__(self) -> str:
+        updates = self.full_updates + self.partial_updates + self.unchanged_updates
+        searched = self.searched / updates if updates else 0.0
+
+        return f'ObjectTracker({len(self.boxes)} objects, {self.full_updates} full, {self.partial_updates} partial, ' \
+               f'{self.unchanged_updates} unchanged updates, {searched:.0%} of the frame searched on average)'
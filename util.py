@@ -1,5 +1,11 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from enum import Enum
+from threading import Lock
+from typing import Callable, Optional
 
 @dataclass
 class Vec2:
@@ -43,6 +49,9 @@ class Vec3:
     def to_pose(self):
         return Pose(self.x, self.y, self.z)
 
+    def distance(self, other) -> float:
+        return ((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2) ** 0.5
+
     def __add__(self, other):
         if type(other) is Vec2:
             return Vec3(self.x + other.x, self.y + other.y, self.z)
@@ -92,6 +101,12 @@ class Pose:
     def to_tuple(self) -> tuple:
         return self.x, self.y, self.z, self.rx, self.ry, self.rz
 
+    def distance(self, other) -> float:
+        """
+        Distance between the positions, orientation is ignored
+        """
+        return ((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2) ** 0.5
+
     def __add__(self, other):
         if type(other) is Vec2:
             return Pose(self.x + other.x, self.y + other.y, 0.0, rx=self.rx, ry=self.ry, rz=self.rz)
@@ -157,5 +172,78 @@ class Direction(Enum):
     NONE = 3
 
 
+def wait_until(condition: Callable[[], bool], timeout: float, interval=0.005, backoff=1.0,
+               max_interval: Optional[float] = None) -> bool:
+    """
+    Poll `condition` until it is true. Returns `False` if `timeout` seconds passed first.
+    The interval is multiplied by `backoff` after every poll, up to `max_interval`.
+    """
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+
+        time.sleep(min(interval, max(0.0, deadline - time.monotonic())))
+        interval *= backoff
+
+        if max_interval is not None:
+            interval = min(interval, max_interval)
+
+    return True
+
+
+class PhaseTimer:
+    """
+    Records how long each phase of a cycle takes.
+    A phase can give the fixed sleep it `replaces`, the report then shows how much time that saved. Such a phase
+    only times the wait that took the place of the sleep, not sending the command before it, which both take.
+    """
+
+    def __init__(self):
+        self.durations: dict[str, list[float]] = {}
+        self.replaces: dict[str, float] = {}
+        self.lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str, replaces=0.0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+
+            with self.lock:
+                self.durations.setdefault(name, []).append(duration)
+                self.replaces[name] = replaces
+
+    def count(self, name: str) -> int:
+        return len(self.durations.get(name, []))
+
+    def report(self, cycle_phase: Optional[str] = None) -> str:
+        """
+        Table of count, mean, total and saved seconds per phase.
+        With `cycle_phase` the number of times that phase ran is used as the number of cycles.
+        """
+        lines = [f'{"phase":<20}{"count":>7}{"mean s":>10}{"total s":>10}{"saved s":>10}']
+        total_saved = 0.0
+
+        with self.lock:
+            for name, durations in self.durations.items():
+                total = sum(durations)
+                saved = self.replaces[name] * len(durations) - total if self.replaces[name] else 0.0
+                total_saved += saved
+
+                lines.append(f'{name:<20}{len(durations):>7}{total / len(durations):>10.3f}{total:>10.3f}'
+                             f'{saved:>10.3f}')
+
+        lines.append(f'Saved compared to fixed sleeps: {total_saved:.3f} s')
+
+        if cycle_phase and (cycles := self.count(cycle_phase)):
+            lines.append(f'Saved per cycle ({cycles} cycles): {total_saved / cycles:.3f} s')
+
+        return '\n'.join(lines)
+
+
 if __name__ == '__main__':
     pass